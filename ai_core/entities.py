@@ -22,8 +22,12 @@ class RPCharacter():
         self.knowledge = None
 
         # These are loaded from config
-        self.triggerword_knowledge = []
+        self.triggerword_knowledge = kwargs.get("triggerword_knowledge", [])
         self.fuzzy_knowledge = []
+        self.knowledge_ttl = kwargs.get("knowledge_ttl", 5)
+        self.knowledge_token_budget = kwargs.get("knowledge_token_budget", 500)
+        self._trigger_knowledge = None
+        self._trigger_knowledge_source = None
         if self.name == "CharacterName":
             log.warning("Character name is not supplied.")
 
@@ -33,6 +37,26 @@ class RPCharacter():
             return self.tasks[0]
         return None
 
+    @property
+    def trigger_knowledge(self):
+        # Automaton is rebuilt only when triggerword_knowledge is replaced or resized
+        source = (id(self.triggerword_knowledge), len(self.triggerword_knowledge))
+        if self._trigger_knowledge is None or self._trigger_knowledge_source != source:
+            from ai_core.knowledge import TriggerKnowledge
+            self._trigger_knowledge = TriggerKnowledge(
+                self.triggerword_knowledge, ttl=self.knowledge_ttl, token_budget=self.knowledge_token_budget
+            )
+            self._trigger_knowledge_source = source
+        return self._trigger_knowledge
+
+    def observe_message(self, message):
+        """Scans a new message for trigger words and updates current context knowledge."""
+        if not self.triggerword_knowledge:
+            return self.knowledge
+        self.trigger_knowledge.observe(message)
+        self.knowledge = self.trigger_knowledge.active_text() or None
+        return self.knowledge
+
     def sample_examples(self, n):
         if not self.examples:
             return []
@@ -1,8 +1,82 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 from ai_core.memory import Message, messages_to_plaintext
 from loguru import logger as log
 
-class CompletionAPI:
+
+class BatchResult():
+    """
+    Results of `batch()` in input order. Failed items have `None` result and their exception in `errors`.
+    """
+    def __init__(self, results, errors, elapsed) -> None:
+        self.results = results
+        self.errors = errors
+        self.elapsed = elapsed
+
+    def __len__(self):
+        return len(self.results)
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __getitem__(self, index):
+        return self.results[index]
+
+    @property
+    def failed(self):
+        return len(self.errors)
+
+    @property
+    def succeeded(self):
+        return len(self.results) - len(self.errors)
+
+    @property
+    def throughput(self):
+        """Completed requests per second."""
+        return self.succeeded / self.elapsed if self.elapsed else 0.0
+
+    def raise_for_errors(self):
+        """Raises the error of the first failed item, if any."""
+        if self.errors:
+            raise next(iter(self.errors.values()))
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(succeeded={self.succeeded}, failed={self.failed}, elapsed={self.elapsed:.2f}s, throughput={self.throughput:.2f}/s)"
+
+
+class _BatchMixin():
+    # Default amount of requests sent concurrently by `batch()` and `map()`
+    batch_max_workers = 4
+
+    def batch(self, items, parameters={}, max_workers=None) -> BatchResult:
+        """
+        Runs the API for every item (prompt, or list of messages for chat) concurrently,
+        with at most `max_workers` requests in flight. Failures are returned per item instead of raised.
+        """
+        errors = {}
+
+        def run(indexed_item):
+            index, item = indexed_item
+            try:
+                return self(item, parameters)
+            except Exception as e:
+                log.warning(f"Batch item {index} failed: {e}")
+                errors[index] = e
+                return None
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max_workers or self.batch_max_workers) as executor:
+            results = list(executor.map(run, enumerate(items)))
+        return BatchResult(results, dict(sorted(errors.items())), time.perf_counter() - start)
+
+    def map(self, items, parameters={}, max_workers=None):
+        """Same as `batch()`, but yields results in order as soon as they are ready and raises on first failure."""
+        with ThreadPoolExecutor(max_workers=max_workers or self.batch_max_workers) as executor:
+            yield from executor.map(lambda item: self(item, parameters), items)
+
+
+class CompletionAPI(_BatchMixin):
     def __call__(self, prompt:str, parameters={}, system_message=""):
         log.debug(f"{self.__class__.__name__} request prompt:\n{prompt}")
         return ""
@@ -11,7 +85,7 @@ class CompletionAPI:
     def loaded_model(self):
         raise NotImplementedError()
 
-class ChatAPI:
+class ChatAPI(_BatchMixin):
     def __call__(self, messages:List[Message], parameters={}):
         log.debug(f"{self.__class__.__name__} request messages:\n{messages_to_plaintext(messages)}")
         return ""
@@ -0,0 +1,213 @@
+"""
+Opt-in response cache for deterministic completions (regenerations, retries, test replays).
+
+Wrap any `CompletionAPI`/`ChatAPI`:
+
+    completion = CachedCompletionAPI(OpenedAI(host=host), cache=CompletionCache(sqlite_path="completions.sqlite"))
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from cachetools import LRUCache
+from loguru import logger as log
+from ai_core.integrations import ChatAPI, CompletionAPI
+from ai_core import memory
+
+
+def encoded_size(value):
+    """Size of a cached response in bytes, as stored (UTF-8)."""
+    return len(value.encode("utf-8"))
+
+
+class CompletionCache():
+    """
+    In-memory LRU bounded by total size of cached responses in UTF-8 bytes, with optional SQLite tier on disk,
+    also bounded by size (least recently used entries are evicted).
+    """
+    def __init__(self, max_memory_bytes=64 * 1024 * 1024, sqlite_path=None, max_disk_bytes=1024 * 1024 * 1024) -> None:
+        self.memory = LRUCache(maxsize=max_memory_bytes, getsizeof=encoded_size)
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = None
+        self._disk_bytes = 0
+        if sqlite_path:
+            if os.path.dirname(sqlite_path):
+                os.makedirs(os.path.dirname(sqlite_path), exist_ok=True)
+            self._db = sqlite3.connect(sqlite_path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS completions_accessed ON completions (accessed)")
+            self._disk_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+
+    def get(self, key):
+        with self._lock:
+            value = self.memory.get(key)
+            if value is None and self._db is not None:
+                row = self._db.execute("SELECT value FROM completions WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    value = row[0]
+                    self._db.execute("UPDATE completions SET accessed = ? WHERE key = ?", (time.time(), key))
+                    self._db.commit()
+                    self._set_memory(key, value)
+                    self.disk_hits += 1
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._set_memory(key, value)
+            if self._db is not None:
+                size = encoded_size(value)
+                row = self._db.execute("SELECT size FROM completions WHERE key = ?", (key,)).fetchone()
+                self._disk_bytes += size - (row[0] if row else 0)
+                self._db.execute("INSERT OR REPLACE INTO completions (key, value, size, accessed) VALUES (?, ?, ?, ?)", (key, value, size, time.time()))
+                self._evict_disk()
+                self._db.commit()
+
+    def _set_memory(self, key, value):
+        if encoded_size(value) <= self.memory.maxsize:
+            self.memory[key] = value
+
+    def _evict_disk(self):
+        while self._disk_bytes > self.max_disk_bytes:
+            rows = self._db.execute("SELECT key, size FROM completions ORDER BY accessed LIMIT 64").fetchall()
+            if not rows:
+                self._disk_bytes = 0
+                return
+            evicted = []
+            for key, size in rows:
+                if self._disk_bytes <= self.max_disk_bytes:
+                    break
+                evicted.append((key,))
+                self._disk_bytes -= size
+            self._db.executemany("DELETE FROM completions WHERE key = ?", evicted)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @property
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "memory_bytes": self.memory.currsize,
+            "disk_bytes": self._disk_bytes,
+        }
+
+    def clear(self):
+        with self._lock:
+            self.memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM completions")
+                self._db.commit()
+                self._disk_bytes = 0
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+def is_deterministic(payload):
+    """Sampling is deterministic with zero temperature, greedy decoding or a fixed seed."""
+    temperature = payload.get('temperature')
+    seed = payload.get('seed')
+    return (
+        (temperature is not None and temperature <= 0)
+        or payload.get('do_sample') is False
+        or (seed is not None and seed >= 0)
+    )
+
+
+class _CachedAPIMixin():
+    def __init__(self, api, cache=None, deterministic_only=True) -> None:
+        """
+        Args:
+            api: Wrapped `CompletionAPI` or `ChatAPI`
+            cache (CompletionCache, optional): Cache to use, can be shared between wrappers. Defaults to in-memory cache.
+            deterministic_only (bool, optional): Only cache requests with deterministic sampling (see `is_deterministic`). Defaults to True.
+        """
+        self.api = api
+        self.cache = cache or CompletionCache()
+        self.deterministic_only = deterministic_only
+
+    @property
+    def loaded_model(self):
+        return self.api.loaded_model
+
+    def _payload(self, *args):
+        if hasattr(self.api, "build_payload") and hasattr(self.api, "filter_payload_by_schema"):
+            return self.api.filter_payload_by_schema(self.api.build_payload(*args))
+        return None
+
+    def cache_key(self, payload):
+        try:
+            model = self.api.loaded_model
+        except NotImplementedError:
+            model = None
+        key = {
+            "host": getattr(self.api, "host", self.api.__class__.__name__),
+            "model": model,
+            "payload": payload,
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True, ensure_ascii=False, default=str).encode()).hexdigest()
+
+    def _cached_call(self, payload, call, serialize, deserialize):
+        if self.deterministic_only and not is_deterministic(payload):
+            return call()
+        key = self.cache_key(payload)
+        cached = self.cache.get(key)
+        if cached is not None:
+            log.debug(f"Completion cache hit: {key}")
+            return deserialize(cached)
+        result = call()
+        self.cache.set(key, serialize(result))
+        return result
+
+
+class CachedCompletionAPI(_CachedAPIMixin, CompletionAPI):
+    def __call__(self, prompt, parameters={}, system_message=""):
+        payload = self._payload(prompt, parameters)
+        if payload is None:
+            payload = dict(parameters, prompt=prompt, system_message=system_message)
+        return self._cached_call(
+            payload,
+            lambda: self.api(prompt, parameters, system_message),
+            serialize=lambda text: text,
+            deserialize=lambda text: text,
+        )
+
+
+class CachedChatAPI(_CachedAPIMixin, ChatAPI):
+    def __call__(self, messages, parameters={}):
+        payload = self._payload(messages, parameters)
+        if payload is None:
+            payload = dict(parameters, messages=[(message.__class__.__name__, message.name, message.text) for message in messages])
+        return self._cached_call(
+            payload,
+            lambda: self.api(messages, parameters),
+            serialize=self.serialize_message,
+            deserialize=self.deserialize_message,
+        )
+
+    @staticmethod
+    def serialize_message(message):
+        return json.dumps({"type": message.__class__.__name__, "name": message.name, "text": message.text}, ensure_ascii=False)
+
+    @staticmethod
+    def deserialize_message(data):
+        data = json.loads(data)
+        message_class = getattr(memory, data['type'], memory.Message)
+        return message_class(text=data['text'], name=data['name'])
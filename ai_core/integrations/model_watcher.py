@@ -0,0 +1,150 @@
+"""
+Cached detection of the model loaded on a host, shared by all clients of that host.
+"""
+import asyncio
+import threading
+import time
+from loguru import logger as log
+
+
+class ModelWatcher():
+    """
+    Keeps name of the model loaded on a host, cached for `ttl` seconds. Can be refreshed in background
+    (thread or asyncio task), callbacks registered with `on_change` are called as `callback(old_model, new_model)`
+    when the model changes, e.g. to update prompt format, stop strings and token limits.
+
+    While background refresh runs, the cached name is returned without waiting, as long as it is not older
+    than `max_stale` seconds (defaults to 3 * ttl); if refreshes keep failing, reads fetch the model themselves again.
+    """
+    def __init__(self, host, ttl=10, max_stale=None) -> None:
+        self.host = host
+        self.ttl = ttl
+        self.max_stale = 3 * ttl if max_stale is None else max_stale
+        self.model_name = None
+        self.checked_at = 0.0
+        self.failures = 0
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._stop_event = None
+        self._thread = None
+        self._task = None
+
+    @property
+    def watching(self):
+        """True while a background refresh thread or task is running."""
+        return (self._thread is not None and self._thread.is_alive()) or (self._task is not None and not self._task.done())
+
+    @property
+    def stale(self):
+        if self.model_name is None:
+            return True
+        age = time.monotonic() - self.checked_at
+        # Background refresh keeps the value current, so readers don't wait for a request unless refreshes fail
+        if self.watching:
+            return age > self.max_stale
+        return age > self.ttl
+
+    def on_change(self, callback):
+        self._callbacks.append(callback)
+        return callback
+
+    def _set(self, model_name):
+        self.failures = 0
+        old_model = self.model_name
+        self.model_name = model_name
+        self.checked_at = time.monotonic()
+        if old_model is not None and old_model != model_name:
+            log.info(f"Model changed on {self.host}: {old_model} -> {model_name}")
+            for callback in list(self._callbacks):
+                try:
+                    callback(old_model, model_name)
+                except Exception as e:
+                    log.exception(e)
+        return model_name
+
+    def refresh(self, fetch):
+        # Fetch happens outside the lock, so `get()` is not blocked by background refreshes
+        model_name = fetch()
+        with self._lock:
+            return self._set(model_name)
+
+    def get(self, fetch):
+        """Returns cached model name, `fetch()` is called only if it is stale."""
+        if self.stale:
+            with self._lock:
+                if self.stale:
+                    return self._set(fetch())
+        return self.model_name
+
+    async def arefresh(self, afetch):
+        model_name = await afetch()
+        with self._lock:
+            return self._set(model_name)
+
+    def _refresh_failed(self, error):
+        self.failures += 1
+        message = f"Unable to refresh loaded model of {self.host} ({self.failures} times in a row): {error}"
+        if self.failures >= 3:
+            log.error(message)
+        else:
+            log.warning(message)
+
+    async def aget(self, afetch):
+        if self.stale:
+            return await self.arefresh(afetch)
+        return self.model_name
+
+    def start(self, fetch, interval=None):
+        """Refreshes model in a background daemon thread every `interval` (defaults to `ttl`) seconds."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        interval = interval or self.ttl
+        self._stop_event = threading.Event()
+
+        def run(stop_event):
+            while not stop_event.is_set():
+                try:
+                    self.refresh(fetch)
+                except Exception as e:
+                    self._refresh_failed(e)
+                stop_event.wait(interval)
+
+        self._thread = threading.Thread(target=run, args=(self._stop_event,), name=f"ModelWatcher({self.host})", daemon=True)
+        self._thread.start()
+
+    def start_async(self, afetch, interval=None):
+        """Refreshes model in an asyncio task of the running loop every `interval` (defaults to `ttl`) seconds."""
+        if self._task is not None and not self._task.done():
+            return self._task
+        interval = interval or self.ttl
+
+        async def run():
+            while True:
+                try:
+                    await self.arefresh(afetch)
+                except Exception as e:
+                    self._refresh_failed(e)
+                await asyncio.sleep(interval)
+
+        self._task = asyncio.get_running_loop().create_task(run())
+        return self._task
+
+    def stop(self):
+        if self._stop_event is not None:
+            self._stop_event.set()
+            self._thread = None
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+def get_model_watcher(host, ttl=10) -> ModelWatcher:
+    """Returns watcher of the host with given ttl, shared between all clients using the same ttl."""
+    with _watchers_lock:
+        watcher = _watchers.get((host, ttl))
+        if watcher is None:
+            watcher = _watchers[(host, ttl)] = ModelWatcher(host, ttl=ttl)
+        return watcher
@@ -1,24 +1,134 @@
+import json
+import threading
 from typing import List, Optional
 from pydantic import BaseModel, PrivateAttr
-from cachetools import TTLCache, cached
 import requests
-from copy import copy
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from copy import copy, deepcopy
 from loguru import logger as log
 from ai_core.integrations import ChatAPI, CompletionAPI
+from ai_core.integrations.schema import schema_registry, filter_payload
+from ai_core.integrations.model_watcher import ModelWatcher, get_model_watcher
 from ai_core.memory import Message, AIMessage, SystemMessage, UserMessage
-from cachetools.keys import hashkey
+
+
+# Only these are retried on 502/503/504: a gateway error on a POST may mean the server is already generating
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD"})
 
 
 class OpenedAIException(Exception):
     pass
 
+class StopStringMatcher():
+    """
+    Detects stop strings in streamed text. The tail that may be the beginning of a stop string
+    is held back until the next delta shows whether it is one.
+    """
+    def __init__(self, stop=None) -> None:
+        self.stop = [stop_string for stop_string in (stop or []) if stop_string]
+        self.buffer = ""
+
+    def feed(self, delta):
+        """Returns text which is safe to emit and whether a stop string was found."""
+        buffer = self.buffer + delta
+        positions = [position for position in (buffer.find(stop_string) for stop_string in self.stop) if position >= 0]
+        if positions:
+            self.buffer = ""
+            return buffer[:min(positions)], True
+
+        keep = 0
+        for stop_string in self.stop:
+            for length in range(min(len(stop_string) - 1, len(buffer)), keep, -1):
+                if buffer.endswith(stop_string[:length]):
+                    keep = length
+                    break
+        self.buffer = buffer[len(buffer) - keep:]
+        return buffer[:len(buffer) - keep], False
+
+    def flush(self):
+        text, self.buffer = self.buffer, ""
+        return text
+
+
+class _CompletionStreamBase():
+    """Stream state shared by sync and async streams."""
+    def __init__(self, events, parse_delta, stop=None) -> None:
+        self._events = events
+        self._parse_delta = parse_delta
+        self._matcher = StopStringMatcher(stop)
+        self.text = ""
+        self.finish_reason = None
+        self.usage = None
+        self.stopped = False
+
+    def _process(self, event):
+        """Returns text to emit for a stream event."""
+        if event.get('usage'):
+            self.usage = event['usage']
+        if not event.get('choices'):
+            return ""
+        choice = event['choices'][0]
+        if choice.get('finish_reason'):
+            self.finish_reason = choice['finish_reason']
+        delta = self._parse_delta(choice)
+        if not delta:
+            return ""
+        text, self.stopped = self._matcher.feed(delta)
+        if self.stopped:
+            self.finish_reason = "stop"
+        self.text += text
+        return text
+
+    def _flush(self):
+        text = self._matcher.flush()
+        self.text += text
+        return text
+
+
+class CompletionStream(_CompletionStreamBase):
+    """
+    Iterates over text deltas of a streamed completion. Stop strings are detected client-side, the request is closed
+    (and generation on the server cancelled) as soon as one appears, or when `close()` is called.
+    After iteration `text`, `finish_reason` and `usage` are available.
+    """
+    def __iter__(self):
+        try:
+            for event in self._events:
+                text = self._process(event)
+                if text:
+                    yield text
+                if self.stopped:
+                    return
+            text = self._flush()
+            if text:
+                yield text
+        finally:
+            self.close()
+
+    def close(self):
+        self._events.close()
+
+
 class _OpenedAICommonMixin(BaseModel):
     host: str
+    # Max pooled keep-alive connections to the host
+    pool_size: int = 10
+    # Retries of failed connections (any request) and 502/503/504 responses (GET only), with exponential backoff
+    max_retries: int = 3
+    backoff_factor: float = 0.5
+    # Seconds, connection timeout and read timeout of completion requests
+    connect_timeout: float = 10
+    timeout: float = 600
+    # Seconds loaded model name is cached for
+    model_ttl: float = 10
     _base_url: str = PrivateAttr()
     _completions_url: str = PrivateAttr()
     _chat_completions_url: str = PrivateAttr()
     _model_info_url: str = PrivateAttr()
     _tokens_url: str = PrivateAttr()
+    _adapter: HTTPAdapter = PrivateAttr()
+    _sessions: threading.local = PrivateAttr(default_factory=threading.local)
     
     def __init__(self, **data):
         super().__init__(**data)
@@ -30,19 +140,77 @@ class _OpenedAICommonMixin(BaseModel):
         self._model_info_url = f'{self._base_url}/internal/model/info'
         self._tokens_url = f'{self._base_url}/internal/token-count'
 
-    def get_allowed_payload_keys(self):
-        log.warning("Not implemented on base mixin class. Wrong function used.")
-        raise NotImplementedError("Not implemented on base mixin class. Wrong function used.")
+        # Only failures where the server did not start processing the request are retried: connection errors,
+        # and 502/503/504 of idempotent requests. Read errors are not, retrying a timed out POST would start another generation.
+        retry = Retry(
+            total=self.max_retries,
+            connect=self.max_retries,
+            read=False,
+            other=0,
+            status=self.max_retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=IDEMPOTENT_METHODS,
+            raise_on_status=False,
+        )
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+
+    def __deepcopy__(self, memo=None):
+        # Connection pool and sessions are not copied, the copy creates its own
+        return self.__class__(**deepcopy(self.__dict__, memo))
+
+    @property
+    def session(self) -> requests.Session:
+        """
+        Session of the current thread. All sessions of the instance share one connection pool,
+        which is thread safe, so connections are kept alive and reused across threads.
+        """
+        session = getattr(self._sessions, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.mount("http://", self._adapter)
+            session.mount("https://", self._adapter)
+            session.headers.update({"Content-Type": "application/json"})
+            self._sessions.session = session
+        return session
+
+    @property
+    def _request_timeout(self):
+        return (self.connect_timeout, self.timeout)
+
+    def close(self):
+        self._adapter.close()
+
+    def _stream_events(self, url, payload):
+        """Posts streaming request and yields decoded server-sent events. Closing the generator closes the connection."""
+        response = self.session.post(url, json=payload, timeout=self._request_timeout, stream=True)
+        try:
+            if response.status_code != 200:
+                log.warning(f"ERROR: {response.status_code} {response.text}")
+                raise OpenedAIException(f"Error response from the server ({url}): {response.status_code} ({response.text})")
+            for line in response.iter_lines():
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    break
+                yield json.loads(data)
+        finally:
+            response.close()
+
+    def get_allowed_payload_keys(self) -> Optional[frozenset]:
+        schema_name = getattr(self, "schema_name", None)
+        if schema_name is None:
+            log.warning("Not implemented on base mixin class. Wrong function used.")
+            raise NotImplementedError("Not implemented on base mixin class. Wrong function used.")
+        schema = schema_registry.get(self.host, self.session, timeout=self._request_timeout)
+        return schema_registry.allowed_keys_for(schema, self.host, schema_name)
 
     def filter_payload_by_schema(self, payload):
         """
         Remove keys that are not allowed, based on swagger api schema available in ooba
         """
-        remove_keys = [key for key in payload.keys() if key not in self.get_allowed_payload_keys()]
-        for key in remove_keys:
-            payload.pop(key, None)
-
-        return payload
+        return filter_payload(payload, self.get_allowed_payload_keys())
     
     def __key(self):
         return (self.host)
@@ -55,67 +223,86 @@ class _OpenedAICommonMixin(BaseModel):
             return self.__key() == other.__key()
         return NotImplemented
     
+    @property
+    def model_watcher(self) -> ModelWatcher:
+        return get_model_watcher(self.host, ttl=self.model_ttl)
+
+    def fetch_loaded_model(self):
+        return self.session.get(self._model_info_url, timeout=self._request_timeout).json()['model_name']
+
     @property
     def loaded_model(self):
-        return requests.get(self._model_info_url).json()['model_name']
+        """Name of the loaded model, cached for `model_ttl` seconds (shared by all clients of the host)."""
+        return self.model_watcher.get(self.fetch_loaded_model)
 
-class OpenedAI(_OpenedAICommonMixin, CompletionAPI):
-    def __call__(self, prompt, parameters={}, system_message=""):
-        super().__call__(prompt, parameters, system_message)
+    def on_model_change(self, callback):
+        """Registers `callback(old_model, new_model)`, called when another model is loaded on the host."""
+        return self.model_watcher.on_change(callback)
+
+    def watch_loaded_model(self, interval=None):
+        """Refreshes loaded model in background, so `loaded_model` never blocks on a request."""
+        self.model_watcher.start(self.fetch_loaded_model, interval=interval)
 
+class _OpenedAICompletionMixin():
+    """Payloads and responses of `/v1/completions`, shared by sync and async clients."""
+    schema_name = "CompletionRequest"
+
+    def build_payload(self, prompt, parameters={}):
         payload = {
             "prompt": prompt,
             "stream": False
         }
-
         payload.update(parameters)
+        return payload
 
-        payload = self.filter_payload_by_schema(payload)
-        response = requests.post(self._completions_url, json=payload, headers={"Content-Type": "application/json"})
+    def build_stream_payload(self, prompt, parameters={}):
+        payload = self.build_payload(prompt, parameters)
+        payload.update({"stream": True, "stream_options": {"include_usage": True}})
+        return payload
 
-        if response.status_code != 200:
-            log.warning(f"ERROR: {response.status_code} {response.text}")
-            raise OpenedAIException(f"Error response from the server ({self._completions_url}): {response.status_code} ({response.text})")
+    def parse_stream_delta(self, choice):
+        return choice.get('text')
 
-        response_text = response.json()['choices'][0]['text']
+    def parse_response(self, data):
+        response_text = data['choices'][0]['text']
 
         log.debug(f"AI:\n{response_text}")
-        log.debug(f"Finish reason: {response.json()['choices'][0]['finish_reason']}")
+        log.debug(f"Finish reason: {data['choices'][0]['finish_reason']}")
         return response_text
-    
-    @cached(cache=TTLCache(maxsize=4, ttl=3600))
-    def get_allowed_payload_keys(self):
-        openapi_json = requests.get(self.host + "/openapi.json").json()
-        allowed_keys = openapi_json['components']['schemas']['CompletionRequest']['properties'].keys()
-        return allowed_keys
 
-class OpenedAIChat(_OpenedAICommonMixin, ChatAPI):
-    def __call__(self, messages, parameters={}):
-        super().__call__(messages, parameters)
+
+class _OpenedAIChatMixin():
+    """Payloads and responses of `/v1/chat/completions`, shared by sync and async clients."""
+    schema_name = "ChatCompletionRequest"
+
+    def build_payload(self, messages, parameters={}):
         payload = dict(
             messages = self.convert_messages_to_openedai_dict(messages=messages)
         )
         payload.update(parameters)
+        return payload
 
-        payload = self.filter_payload_by_schema(payload)
-        response = requests.post(self._chat_completions_url, json=payload, headers={"Content-Type": "application/json"})
+    def build_stream_payload(self, messages, parameters={}):
+        payload = self.build_payload(messages, parameters)
+        payload.update({"stream": True, "stream_options": {"include_usage": True}})
+        return payload
 
-        if response.status_code != 200:
-            log.warning(f"ERROR: {response.status_code} {response.text}")
-            raise OpenedAIException(f"Error response from the server ({self._chat_completions_url}): {response.status_code} ({response.text})")
-        
-        response_message = self.convert_openedai_message_to_message(response.json()['choices'][0]['message'])
+    def parse_stream_delta(self, choice):
+        return (choice.get('delta') or {}).get('content')
+
+    def parse_response(self, data):
+        response_message = self.convert_openedai_message_to_message(data['choices'][0]['message'])
 
         log.debug(f"AI:\n{response_message}")
-        log.debug(f"Finish reason: {response.json()['choices'][0]['finish_reason']}")
+        log.debug(f"Finish reason: {data['choices'][0]['finish_reason']}")
         return response_message
-    
+
     def convert_openedai_message_to_message(self, message:dict):
         if message['role'] == "assistant":
             message = AIMessage(text=message['content'])
         elif message['role'] == "system":
             message = SystemMessage(text=message['content'])
-        elif message['role'] == "assistant":
+        elif message['role'] == "user":
             message = UserMessage(text=message['content'])
         return message
 
@@ -136,9 +323,48 @@ class OpenedAIChat(_OpenedAICommonMixin, ChatAPI):
             )
         return openedai_messages
 
-    @cached(cache=TTLCache(maxsize=4, ttl=30))
-    def get_allowed_payload_keys(self):
-        openapi_json = requests.get(self.host + "/openapi.json").json()
-        allowed_keys = list(openapi_json['components']['schemas']['ChatCompletionRequest']['properties'].keys())
-        return allowed_keys
 
+class OpenedAI(_OpenedAICompletionMixin, _OpenedAICommonMixin, CompletionAPI):
+    def __call__(self, prompt, parameters={}, system_message=""):
+        super().__call__(prompt, parameters, system_message)
+
+        payload = self.filter_payload_by_schema(self.build_payload(prompt, parameters))
+        response = self.session.post(self._completions_url, json=payload, timeout=self._request_timeout)
+
+        if response.status_code != 200:
+            log.warning(f"ERROR: {response.status_code} {response.text}")
+            raise OpenedAIException(f"Error response from the server ({self._completions_url}): {response.status_code} ({response.text})")
+
+        return self.parse_response(response.json())
+
+    def stream(self, prompt, parameters={}, system_message="") -> CompletionStream:
+        """
+        Streams completion, iterate over the result to get text deltas. Request is sent on first iteration.
+        `parameters['stop']` strings are also checked client-side.
+        """
+        CompletionAPI.__call__(self, prompt, parameters, system_message)
+        payload = self.filter_payload_by_schema(self.build_stream_payload(prompt, parameters))
+        return CompletionStream(self._stream_events(self._completions_url, payload), self.parse_stream_delta, stop=parameters.get('stop'))
+
+
+class OpenedAIChat(_OpenedAIChatMixin, _OpenedAICommonMixin, ChatAPI):
+    def __call__(self, messages, parameters={}):
+        super().__call__(messages, parameters)
+
+        payload = self.filter_payload_by_schema(self.build_payload(messages, parameters))
+        response = self.session.post(self._chat_completions_url, json=payload, timeout=self._request_timeout)
+
+        if response.status_code != 200:
+            log.warning(f"ERROR: {response.status_code} {response.text}")
+            raise OpenedAIException(f"Error response from the server ({self._chat_completions_url}): {response.status_code} ({response.text})")
+        
+        return self.parse_response(response.json())
+
+    def stream(self, messages, parameters={}) -> CompletionStream:
+        """
+        Streams chat completion, iterate over the result to get text deltas. Request is sent on first iteration.
+        `parameters['stop']` strings are also checked client-side.
+        """
+        ChatAPI.__call__(self, messages, parameters)
+        payload = self.filter_payload_by_schema(self.build_stream_payload(messages, parameters))
+        return CompletionStream(self._stream_events(self._chat_completions_url, payload), self.parse_stream_delta, stop=parameters.get('stop'))
@@ -0,0 +1,217 @@
+"""
+Asyncio counterparts of OpenedAI clients, for driving many generations from one event loop.
+Requires `aiohttp` (`pip install ai_core[async]`).
+"""
+import asyncio
+import json
+import time
+from typing import Optional
+import aiohttp
+from pydantic import PrivateAttr
+from loguru import logger as log
+from ai_core.integrations import BatchResult, ChatAPI, CompletionAPI
+from ai_core.integrations.schema import schema_registry, filter_payload
+from ai_core.integrations.openedai import (
+    IDEMPOTENT_METHODS,
+    OpenedAIException,
+    _CompletionStreamBase,
+    _OpenedAICommonMixin,
+    _OpenedAICompletionMixin,
+    _OpenedAIChatMixin,
+)
+
+RETRY_STATUSES = (502, 503, 504)
+# Errors raised before the request reached the server, safe to retry even for POST
+RETRY_EXCEPTIONS = (aiohttp.ClientConnectorError,) + (
+    (aiohttp.ConnectionTimeoutError,) if hasattr(aiohttp, "ConnectionTimeoutError") else ()
+)
+
+
+class AsyncCompletionStream(_CompletionStreamBase):
+    """
+    Async iterator over text deltas of a streamed completion, see `ai_core.integrations.openedai.CompletionStream`.
+    """
+    async def __aiter__(self):
+        try:
+            async for event in self._events:
+                text = self._process(event)
+                if text:
+                    yield text
+                if self.stopped:
+                    return
+            text = self._flush()
+            if text:
+                yield text
+        finally:
+            await self.aclose()
+
+    async def aclose(self):
+        await self._events.aclose()
+
+
+class _AsyncOpenedAICommonMixin(_OpenedAICommonMixin):
+    # Max requests in flight (and pooled connections), further calls wait for a free slot
+    max_concurrency: int = 64
+    _client: Optional[aiohttp.ClientSession] = PrivateAttr(default=None)
+    _client_loop: Optional[asyncio.AbstractEventLoop] = PrivateAttr(default=None)
+    _semaphore: Optional[asyncio.Semaphore] = PrivateAttr(default=None)
+
+    @property
+    def client(self) -> aiohttp.ClientSession:
+        """Pooled aiohttp session, created on first use in the running event loop."""
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client.closed or self._client_loop is not loop:
+            self._client = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+                timeout=aiohttp.ClientTimeout(total=None, connect=self.connect_timeout, sock_read=self.timeout),
+                headers={"Content-Type": "application/json"},
+            )
+            self._client_loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._client
+
+    async def _request(self, method, url, **kwargs):
+        """
+        Sends request and returns decoded json. Failures to connect, and 502/503/504 responses of GET requests
+        are retried with backoff. Read errors, timeouts and gateway errors of POST are not, so a generation is never started twice.
+        Cancelling the calling task aborts the request.
+        """
+        client = self.client
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    async with client.request(method, url, **kwargs) as response:
+                        retryable = response.status in RETRY_STATUSES and method.upper() in IDEMPOTENT_METHODS
+                        if not retryable or attempt >= self.max_retries:
+                            if response.status != 200:
+                                text = await response.text()
+                                log.warning(f"ERROR: {response.status} {text}")
+                                raise OpenedAIException(f"Error response from the server ({url}): {response.status} ({text})")
+                            return await response.json(content_type=None)
+                except RETRY_EXCEPTIONS:
+                    if attempt >= self.max_retries:
+                        raise
+                await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+
+    async def _astream_events(self, url, payload):
+        """Posts streaming request and yields decoded server-sent events. Closing the generator closes the connection."""
+        client = self.client
+        async with self._semaphore:
+            async with client.post(url, json=payload) as response:
+                if response.status != 200:
+                    text = await response.text()
+                    log.warning(f"ERROR: {response.status} {text}")
+                    raise OpenedAIException(f"Error response from the server ({url}): {response.status} ({text})")
+                finished = False
+                try:
+                    async for line in response.content:
+                        if not line.startswith(b"data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == b"[DONE]":
+                            break
+                        yield json.loads(data)
+                    finished = True
+                finally:
+                    if not finished:
+                        # Dropping the connection cancels generation on the server
+                        response.close()
+
+    async def _astream(self, url, payload):
+        payload = await self.afilter_payload_by_schema(payload)
+        async for event in self._astream_events(url, payload):
+            yield event
+
+    async def aget_allowed_payload_keys(self) -> Optional[frozenset]:
+        schema = await schema_registry.aget(self.host, self.client)
+        return schema_registry.allowed_keys_for(schema, self.host, self.schema_name)
+
+    async def afilter_payload_by_schema(self, payload):
+        return filter_payload(payload, await self.aget_allowed_payload_keys())
+
+    async def afetch_loaded_model(self):
+        return (await self._request("GET", self._model_info_url))['model_name']
+
+    async def aloaded_model(self):
+        """Name of the loaded model, cached for `model_ttl` seconds (shared by all clients of the host)."""
+        return await self.model_watcher.aget(self.afetch_loaded_model)
+
+    def watch_loaded_model(self, interval=None):
+        """Refreshes loaded model in an asyncio task of the running loop."""
+        return self.model_watcher.start_async(self.afetch_loaded_model, interval=interval)
+
+    async def batch(self, items, parameters={}, max_workers=None) -> BatchResult:
+        """
+        Runs the API for every item concurrently, at most `max_workers` (default `max_concurrency`) at a time.
+        Failures are returned per item instead of raised.
+        """
+        semaphore = asyncio.Semaphore(max_workers or self.max_concurrency)
+        errors = {}
+
+        async def run(index, item):
+            async with semaphore:
+                try:
+                    return await self(item, parameters)
+                except Exception as e:
+                    log.warning(f"Batch item {index} failed: {e}")
+                    errors[index] = e
+                    return None
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*[run(index, item) for index, item in enumerate(items)])
+        return BatchResult(list(results), dict(sorted(errors.items())), time.perf_counter() - start)
+
+    async def map(self, items, parameters={}, max_workers=None):
+        """Same as `batch()`, but yields results in order as soon as they are ready and raises on first failure."""
+        semaphore = asyncio.Semaphore(max_workers or self.max_concurrency)
+
+        async def run(item):
+            async with semaphore:
+                return await self(item, parameters)
+
+        tasks = [asyncio.ensure_future(run(item)) for item in items]
+        try:
+            for task in tasks:
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+
+class AsyncOpenedAI(_OpenedAICompletionMixin, _AsyncOpenedAICommonMixin, CompletionAPI):
+    async def __call__(self, prompt, parameters={}, system_message=""):
+        super().__call__(prompt, parameters, system_message)
+
+        payload = await self.afilter_payload_by_schema(self.build_payload(prompt, parameters))
+        data = await self._request("POST", self._completions_url, json=payload)
+        return self.parse_response(data)
+
+    def stream(self, prompt, parameters={}, system_message="") -> AsyncCompletionStream:
+        """Streams completion, use `async for` over the result to get text deltas. Request is sent on first iteration."""
+        CompletionAPI.__call__(self, prompt, parameters, system_message)
+        return AsyncCompletionStream(self._astream(self._completions_url, self.build_stream_payload(prompt, parameters)), self.parse_stream_delta, stop=parameters.get('stop'))
+
+
+class AsyncOpenedAIChat(_OpenedAIChatMixin, _AsyncOpenedAICommonMixin, ChatAPI):
+    async def __call__(self, messages, parameters={}):
+        super().__call__(messages, parameters)
+
+        payload = await self.afilter_payload_by_schema(self.build_payload(messages, parameters))
+        data = await self._request("POST", self._chat_completions_url, json=payload)
+        return self.parse_response(data)
+
+    def stream(self, messages, parameters={}) -> AsyncCompletionStream:
+        """Streams chat completion, use `async for` over the result to get text deltas. Request is sent on first iteration."""
+        ChatAPI.__call__(self, messages, parameters)
+        return AsyncCompletionStream(self._astream(self._chat_completions_url, self.build_stream_payload(messages, parameters)), self.parse_stream_delta, stop=parameters.get('stop'))
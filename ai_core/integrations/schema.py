@@ -0,0 +1,178 @@
+"""
+Registry of OpenAPI schemas of OpenedAI servers, used to drop payload keys a server does not accept.
+
+The schema document is fetched once per host, revalidated with ETag (conditional requests) after
+`revalidate_after` seconds, and cached on disk so that restarts do not refetch it.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from loguru import logger as log
+
+DEFAULT_CACHE_DIR = os.environ.get("AI_CORE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "ai_core"))
+
+
+class OpenAPISchema():
+    """Allowed payload keys of every request schema of a server, as frozensets."""
+    def __init__(self, allowed_keys, etag=None, fetched_at=None) -> None:
+        self.allowed_keys = {name: frozenset(keys) for name, keys in allowed_keys.items()}
+        self.etag = etag
+        self.fetched_at = fetched_at or time.time()
+
+    @classmethod
+    def from_document(cls, document, etag=None):
+        schemas = document.get('components', {}).get('schemas', {})
+        return cls(
+            {name: (schema.get('properties') or {}).keys() for name, schema in schemas.items()},
+            etag=etag,
+        )
+
+    def to_dict(self):
+        return {
+            "etag": self.etag,
+            "fetched_at": self.fetched_at,
+            "allowed_keys": {name: sorted(keys) for name, keys in self.allowed_keys.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['allowed_keys'], etag=data.get('etag'), fetched_at=data.get('fetched_at'))
+
+
+class OpenAPISchemaRegistry():
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, revalidate_after=3600) -> None:
+        self.cache_dir = cache_dir
+        self.revalidate_after = revalidate_after
+        self._schemas = {}
+        self._lock = threading.Lock()
+        self._host_locks = {}
+        self._async_locks = {}
+        # (host, schema name) pairs already reported as missing
+        self._missing_schemas = set()
+
+    def _cache_filepath(self, host):
+        if not self.cache_dir:
+            return None
+        return os.path.join(self.cache_dir, "openapi", hashlib.sha1(host.encode()).hexdigest() + ".json")
+
+    def _load_from_disk(self, host):
+        filepath = self._cache_filepath(host)
+        if not filepath or not os.path.exists(filepath):
+            return None
+        try:
+            with open(filepath, "r", encoding="utf-8") as f:
+                return OpenAPISchema.from_dict(json.load(f))
+        except Exception as e:
+            log.warning(f"Unable to read cached schema of {host} ({filepath}): {e}")
+            return None
+
+    def _save_to_disk(self, host, schema):
+        filepath = self._cache_filepath(host)
+        if not filepath:
+            return
+        try:
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            tmp_filepath = f"{filepath}.{os.getpid()}.tmp"
+            with open(tmp_filepath, "w", encoding="utf-8") as f:
+                json.dump(schema.to_dict(), f)
+            os.replace(tmp_filepath, filepath)
+        except Exception as e:
+            log.warning(f"Unable to cache schema of {host} ({filepath}): {e}")
+
+    def _cached(self, host):
+        """Returns (schema, needs_revalidation)."""
+        schema = self._schemas.get(host)
+        if schema is None:
+            schema = self._load_from_disk(host)
+            if schema is not None:
+                self._schemas[host] = schema
+        if schema is None:
+            return None, True
+        return schema, time.time() - schema.fetched_at > self.revalidate_after
+
+    def _update(self, host, schema, status, document, etag):
+        """Applies revalidation response, returns current schema."""
+        if status == 304 and schema is not None:
+            schema.fetched_at = time.time()
+        else:
+            schema = OpenAPISchema.from_document(document, etag=etag)
+            log.debug(f"Fetched OpenAPI schema of {host}")
+        self._schemas[host] = schema
+        self._save_to_disk(host, schema)
+        return schema
+
+    def _conditional_headers(self, schema):
+        return {"If-None-Match": schema.etag} if schema is not None and schema.etag else {}
+
+    def get(self, host, session, timeout=30) -> OpenAPISchema:
+        schema, stale = self._cached(host)
+        if not stale:
+            return schema
+        with self._lock:
+            host_lock = self._host_locks.setdefault(host, threading.Lock())
+        with host_lock:
+            schema, stale = self._cached(host)
+            if not stale:
+                return schema
+            try:
+                response = session.get(host + "/openapi.json", headers=self._conditional_headers(schema), timeout=timeout)
+                if response.status_code != 304:
+                    # Error bodies must never be cached as a schema
+                    response.raise_for_status()
+                document = response.json() if response.status_code != 304 else None
+                return self._update(host, schema, response.status_code, document, response.headers.get("ETag"))
+            except Exception as e:
+                if schema is None:
+                    raise
+                log.warning(f"Unable to revalidate schema of {host}, using cached one: {e}")
+                return schema
+
+    async def aget(self, host, client) -> OpenAPISchema:
+        """Same as `get`, using aiohttp session."""
+        schema, stale = self._cached(host)
+        if not stale:
+            return schema
+        key = (host, id(asyncio.get_running_loop()))
+        host_lock = self._async_locks.setdefault(key, asyncio.Lock())
+        async with host_lock:
+            schema, stale = self._cached(host)
+            if not stale:
+                return schema
+            try:
+                async with client.get(host + "/openapi.json", headers=self._conditional_headers(schema)) as response:
+                    if response.status != 304:
+                        response.raise_for_status()
+                    document = await response.json(content_type=None) if response.status != 304 else None
+                    return self._update(host, schema, response.status, document, response.headers.get("ETag"))
+            except Exception as e:
+                if schema is None:
+                    raise
+                log.warning(f"Unable to revalidate schema of {host}, using cached one: {e}")
+                return schema
+
+    def allowed_keys_for(self, schema, host, schema_name):
+        """Allowed keys of schema_name, None (no filtering) if the server does not describe it."""
+        allowed_keys = schema.allowed_keys.get(schema_name)
+        if allowed_keys is None and (host, schema_name) not in self._missing_schemas:
+            self._missing_schemas.add((host, schema_name))
+            log.warning(f"Schema {schema_name} is not found in OpenAPI schema of {host}, payload is not filtered.")
+        return allowed_keys
+
+    def invalidate(self, host=None):
+        with self._lock:
+            if host is None:
+                self._schemas = {}
+            else:
+                self._schemas.pop(host, None)
+
+
+def filter_payload(payload, allowed_keys):
+    """Returns copy of payload with allowed keys only, in a single pass. No filtering if allowed_keys is None."""
+    if allowed_keys is None:
+        return dict(payload)
+    return {key: value for key, value in payload.items() if key in allowed_keys}
+
+schema_registry = OpenAPISchemaRegistry()
@@ -0,0 +1,171 @@
+"""
+Trigger-word knowledge (lorebook) injection: entries are activated when one of their trigger words
+appears in the conversation and stay active for `ttl` messages.
+"""
+from collections import deque
+from typing import Dict, Iterable, List, Optional
+from ai_core.utils.tokenizers import get_tokenizer
+
+
+class KnowledgeEntry():
+    __slots__ = ("triggers", "text", "priority", "ttl", "_token_count")
+
+    def __init__(self, triggers, text, priority=0, ttl=None) -> None:
+        self.triggers = [triggers] if isinstance(triggers, str) else list(triggers)
+        self.text = text
+        self.priority = priority
+        # Overrides engine ttl for this entry
+        self.ttl = ttl
+        self._token_count = None
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data.get('triggers') or data.get('keys') or [],
+            data.get('text') or data.get('content') or "",
+            priority=data.get('priority', 0),
+            ttl=data.get('ttl'),
+        )
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.triggers}, {self.text[:40]!r})"
+
+
+class TriggerAutomaton():
+    """
+    Aho-Corasick automaton matching all trigger words in a single pass over the text (case insensitive).
+    """
+    def __init__(self, patterns: Iterable[str], whole_words=True) -> None:
+        self.whole_words = whole_words
+        self.patterns = []
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail = [0]
+        # Pattern ids ending at each state, including those reachable through fail links
+        self._output: List[List[int]] = [[]]
+        pattern_ids = {}
+        for pattern in patterns:
+            pattern = pattern.lower()
+            if not pattern or pattern in pattern_ids:
+                continue
+            pattern_ids[pattern] = len(self.patterns)
+            self.patterns.append(pattern)
+            self._insert(pattern, pattern_ids[pattern])
+        self.pattern_ids = pattern_ids
+        self._build_fail_links()
+
+    def _insert(self, pattern, pattern_id):
+        state = 0
+        for char in pattern:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = next_state
+        self._output[state].append(pattern_id)
+
+    def _build_fail_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def find(self, text) -> set:
+        """Returns ids of patterns found in text."""
+        text = text.lower()
+        goto, fail, output, patterns = self._goto, self._fail, self._output, self.patterns
+        found = set()
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                for pattern_id in output[state]:
+                    if pattern_id in found:
+                        continue
+                    if self.whole_words:
+                        start = position - len(patterns[pattern_id]) + 1
+                        if (start > 0 and text[start - 1].isalnum()) or (position + 1 < len(text) and text[position + 1].isalnum()):
+                            continue
+                    found.add(pattern_id)
+        return found
+
+
+class TriggerKnowledge():
+    """
+    Activates knowledge entries when their trigger words appear in observed messages. Only new messages are scanned
+    (call `observe` for each added message). An entry stays active for `ttl` messages after its last trigger;
+    `active_entries` returns the most recently triggered ones (then by priority) that fit into the token budget.
+    """
+    def __init__(self, entries: Iterable[KnowledgeEntry], ttl=5, token_budget=500, whole_words=True, tokenizer=None) -> None:
+        self.entries = [entry if isinstance(entry, KnowledgeEntry) else KnowledgeEntry.from_dict(entry) for entry in entries]
+        self.ttl = ttl
+        self.token_budget = token_budget
+        self.tokenizer = get_tokenizer(tokenizer)
+        self.automaton = TriggerAutomaton((trigger for entry in self.entries for trigger in entry.triggers), whole_words=whole_words)
+        self._pattern_entries = [[] for _ in self.automaton.patterns]
+        for entry_id, entry in enumerate(self.entries):
+            for trigger in entry.triggers:
+                pattern_id = self.automaton.pattern_ids.get(trigger.lower())
+                if pattern_id is not None:
+                    self._pattern_entries[pattern_id].append(entry_id)
+        self.turn = 0
+        # entry id -> turn of the last activation
+        self.activations: Dict[int, int] = {}
+
+    def observe(self, message) -> List[KnowledgeEntry]:
+        """Scans a new message (Message or text), returns entries it triggered."""
+        self.turn += 1
+        text = message if isinstance(message, str) else message.text
+        triggered = {entry_id for pattern_id in self.automaton.find(text) for entry_id in self._pattern_entries[pattern_id]}
+        for entry_id in triggered:
+            self.activations[entry_id] = self.turn
+        self._expire()
+        return [self.entries[entry_id] for entry_id in sorted(triggered)]
+
+    def observe_many(self, messages):
+        for message in messages:
+            self.observe(message)
+
+    def _expire(self):
+        expired = [
+            entry_id for entry_id, turn in self.activations.items()
+            if self.turn - turn >= (self.entries[entry_id].ttl if self.entries[entry_id].ttl is not None else self.ttl)
+        ]
+        for entry_id in expired:
+            del self.activations[entry_id]
+
+    def _token_count(self, entry):
+        if entry._token_count is None:
+            entry._token_count = self.tokenizer(entry.text)
+        return entry._token_count
+
+    def active_entries(self, token_budget: Optional[int] = None) -> List[KnowledgeEntry]:
+        token_budget = self.token_budget if token_budget is None else token_budget
+        ranked = sorted(self.activations.items(), key=lambda item: (-item[1], -self.entries[item[0]].priority, item[0]))
+        selected = []
+        used = 0
+        for entry_id, _ in ranked:
+            entry = self.entries[entry_id]
+            token_count = self._token_count(entry)
+            if used + token_count > token_budget:
+                continue
+            selected.append(entry)
+            used += token_count
+        return selected
+
+    def active_text(self, token_budget: Optional[int] = None, joiner="\n"):
+        return joiner.join(entry.text for entry in self.active_entries(token_budget))
+
+    def reset(self):
+        self.turn = 0
+        self.activations = {}
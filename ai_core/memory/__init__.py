@@ -1,11 +1,28 @@
-from typing import List, Optional, Callable
-from pydantic import BaseModel
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Any, List, Optional, Callable, ClassVar, Deque
+from pydantic import BaseModel, Field, PrivateAttr
+from loguru import logger as log
 from ai_core.utils import count_tokens_nltk
 
-class Message(BaseModel):
+@dataclass(repr=False, slots=True)
+class Message():
     text: str
-    count_tokens_func: Callable = count_tokens_nltk
     name: str = ""
+    # (count_tokens_func, text, name, count) of the last count
+    _token_count: Optional[tuple] = field(default=None, init=False, compare=False)
+
+    # Token counting strategy of all messages of the class, memories can override it with their `tokenizer`
+    count_tokens_func: ClassVar[Callable] = count_tokens_nltk
+    default_name: ClassVar[str] = ""
+
+    def __post_init__(self):
+        if not self.name:
+            self.name = self.default_name
 
     def __str__(self) -> str:
         return f"{self.__class__.__name__}: {self.text}"
@@ -15,37 +32,80 @@ class Message(BaseModel):
     
     @property
     def token_count(self):
-        return self.count_tokens_func(str(self))
+        """Token count of the message, computed once and memoized until text or name changes."""
+        return self.count_tokens()
+
+    def count_tokens(self, count_tokens_func=None):
+        """Counts tokens with given tokenizer backend (or any count function), defaults to `count_tokens_func` of the class."""
+        count_tokens_func = count_tokens_func or type(self).count_tokens_func
+        cached = self._token_count
+        if cached is not None and cached[0] is count_tokens_func and cached[1] is self.text and cached[2] is self.name:
+            return cached[3]
+        count = count_tokens_func(str(self))
+        self._token_count = (count_tokens_func, self.text, self.name, count)
+        return count
 
 class SystemMessage(Message):
-    def __init__(self, **data):
-        super().__init__(**data)
-        if not self.name:
-            self.name = "System"
+    __slots__ = ()
+    default_name = "System"
 
 class UserMessage(Message):
-    def __init__(self, **data):
-        super().__init__(**data)
-        if not self.name:
-            self.name = "User"
+    __slots__ = ()
+    default_name = "User"
 
 class AIMessage(Message):
-    def __init__(self, **data):
-        super().__init__(**data)
-        if not self.name:
-            self.name = "AI"
+    __slots__ = ()
+    default_name = "AI"
+
+MESSAGE_TYPES = {
+    "system": SystemMessage,
+    "user": UserMessage,
+    "assistant": AIMessage,
+    "ai": AIMessage,
+    "SystemMessage": SystemMessage,
+    "UserMessage": UserMessage,
+    "AIMessage": AIMessage,
+    "Message": Message,
+}
+
+def messages_from_dicts(items, default_type=UserMessage) -> List[Message]:
+    """
+    Creates messages in bulk from dicts with `text`, optional `name` and `type`
+    (class name, or OpenAI style `role`: system/user/assistant).
+    """
+    message_types = MESSAGE_TYPES
+    messages = []
+    append = messages.append
+    for item in items:
+        message_type = item.get('type') or item.get('role')
+        message_class = message_types.get(message_type, default_type) if message_type else default_type
+        append(message_class(item.get('text', item.get('content', "")), item.get('name') or ""))
+    return messages
 
 class Memory(BaseModel):
     messages_all: List[Message] = []
     keep_max: int = 0
+    # Count tokens when message is added instead of on first read
+    precompute_token_counts: bool = False
+    # Tokenizer backend (see `ai_core.utils.tokenizers`) or count function, overrides `Message.count_tokens_func`
+    tokenizer: Optional[Callable] = None
+
+    def count_tokens(self, message):
+        return message.count_tokens(self.tokenizer)
 
     def add_message(self, message):
+        if self.precompute_token_counts:
+            self.count_tokens(message)
         self.messages_all.append(message)
 
         if self.keep_max > 0:
             if len(self.messages_all) > self.keep_max:
                 self.messages_all.pop(0)
 
+    def add_messages(self, messages):
+        for message in messages:
+            self.add_message(message)
+
     @property
     def messages(self):
         return self.messages_all
@@ -55,6 +115,19 @@ class Memory(BaseModel):
     
     def to_plaintext(self):
         return messages_to_plaintext(self.messages)
+
+    def to_prompt(self, template_name='chatml', next_message_name=None, render_cache=None):
+        """
+        Renders current messages (e.g. the sliding window) into a prompt, reusing message fragments rendered on previous turns.
+        Uses shared `ai_core.templating.prompt_render_cache` unless other cache is given.
+        """
+        from ai_core.templating import messages_to_prompt, prompt_render_cache
+        return messages_to_prompt(
+            self.messages,
+            template_name=template_name,
+            next_message_name=next_message_name,
+            render_cache=render_cache or prompt_render_cache,
+        )
     
     def clear(self):
         self.messages_all = []
@@ -78,7 +151,7 @@ class Memory_SlidingWindow(Memory):
         would_be_count = 0
 
         for message in reversed(self.messages_all):
-            would_be_count += message.token_count
+            would_be_count += message.count_tokens(self.tokenizer)
             if would_be_count >= self.token_limit:
                 break
 
@@ -90,3 +163,305 @@ class Memory_SlidingWindow(Memory):
         super().clear()
         self.pinned_messages = []
 
+
+
+class _TokenWindowState():
+    """Window bookkeeping of `Memory_TokenWindow`, kept in a plain object to avoid pydantic attribute overhead."""
+    __slots__ = ("window", "running_total", "start_total", "token_limit")
+
+    def __init__(self, token_limit=None) -> None:
+        # (message, running token total including this message) for every message in the window
+        self.window = deque()
+        self.running_total = 0
+        self.start_total = 0
+        self.token_limit = token_limit
+
+
+class Memory_TokenWindow(Memory):
+    """
+    Same window as `Memory_SlidingWindow` (newest messages that fit into `token_limit`, plus pinned messages),
+    but the window boundary is maintained as messages are added instead of being recomputed on every read.
+
+    Adding a message is O(1) amortized, reading `messages` is O(window). History is kept in a deque,
+    so `keep_max` eviction is O(1) too. Do not modify `messages_all` directly, use `add_message`.
+    """
+    messages_all: Deque[Message] = Field(default_factory=deque)
+    token_limit: int
+    pinned_messages: List[Message] = []
+    _state: _TokenWindowState = PrivateAttr(default_factory=_TokenWindowState)
+
+    def model_post_init(self, __context):
+        self.messages_all = deque(self.messages_all, maxlen=self.keep_max or None)
+        self._rebuild_window()
+
+    @property
+    def window_token_count(self):
+        state = self._state
+        return state.running_total - state.start_total
+
+    def add_message(self, message):
+        state = self._state
+        messages_all = self.messages_all
+        state.running_total += message.count_tokens(self.tokenizer)
+        messages_all.append(message)
+
+        token_limit = self.token_limit
+        if state.token_limit != token_limit:
+            self._rebuild_window()
+            return
+
+        window = state.window
+        window.append((message, state.running_total))
+        while window and (
+            state.running_total - state.start_total >= token_limit or len(window) > len(messages_all)
+        ):
+            evicted, state.start_total = window.popleft()
+            self._on_evict(evicted)
+
+    def _on_evict(self, message):
+        """Called for every message that falls out of the window, including messages left out by a rebuild."""
+        pass
+
+    def _rebuild_window(self):
+        """
+        Recomputes window from history, used on creation and when `token_limit` changes. Messages which were in the window
+        (on creation: all messages of history) but are left out now are passed to `_on_evict`, oldest first.
+        """
+        previous = self._state
+        kept = []
+        would_be_count = 0
+        for message in reversed(self.messages_all):
+            would_be_count += message.count_tokens(self.tokenizer)
+            if would_be_count >= self.token_limit:
+                break
+            kept.append(message)
+
+        # Running totals only matter relative to the window start
+        state = _TokenWindowState(self.token_limit)
+        for message in reversed(kept):
+            state.running_total += message.count_tokens(self.tokenizer)
+            state.window.append((message, state.running_total))
+        self._state = state
+
+        if previous.token_limit is None:
+            candidates = self.messages_all
+        else:
+            candidates = [message for message, _ in previous.window]
+        kept_ids = {id(message) for message in kept}
+        for message in [message for message in candidates if id(message) not in kept_ids]:
+            self._on_evict(message)
+
+    @property
+    def messages(self):
+        if self._state.token_limit != self.token_limit:
+            self._rebuild_window()
+        filtered_messages = list(self.pinned_messages)
+        filtered_messages.extend(message for message, _ in self._state.window)
+        return filtered_messages
+
+    def clear(self):
+        self.messages_all = deque(maxlen=self.keep_max or None)
+        self.pinned_messages = []
+        # Cleared messages are not evicted
+        self._state = _TokenWindowState()
+        self._rebuild_window()
+
+
+class Memory_Summarizing(Memory_TokenWindow):
+    """
+    Token window memory which doesn't lose messages falling out of the window: they are summarized in a background
+    thread by `completion` (`CompletionAPI` or `ChatAPI`) and folded into a rolling summary, pinned as a system message
+    after `pinned_messages`. Neither `add_message` nor reading `messages` wait for summarization.
+
+    Evicted messages are summarized in chunks of `chunk_size` messages. Up to `summary_cache_size` summaries are cached by hash of
+    (previous summary, chunk), and appended to `summary_cache_path` file (JSON lines) if given, so replaying history
+    after restart doesn't summarize again. If summarization fails, `wait()` raises the error.
+    """
+    completion: Any = None
+    chunk_size: int = 4
+    template_name: str = 'chatml'
+    summary_parameters: dict = {"temperature": 0, "max_tokens": 500}
+    summary_cache_path: Optional[str] = None
+    summary_cache_size: int = 1024
+    summarize_instruction: str = (
+        "Summarize the conversation. Merge the new messages into the existing summary, "
+        "keep names, facts, decisions and unresolved questions. Output only the summary."
+    )
+    summary_template: str = "Summary of the earlier conversation:\n{{summary}}"
+
+    _summary: str = PrivateAttr(default="")
+    _pending: list = PrivateAttr(default_factory=list)
+    _cache: OrderedDict = PrivateAttr(default_factory=OrderedDict)
+    _cache_file_entries: int = PrivateAttr(default=0)
+    _error: Optional[Exception] = PrivateAttr(default=None)
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+    _wakeup: Any = PrivateAttr(default_factory=threading.Condition)
+    _worker: Any = PrivateAttr(default=None)
+    _busy: bool = PrivateAttr(default=False)
+
+    def model_post_init(self, __context):
+        self._load_cache()
+        super().model_post_init(__context)
+
+    @property
+    def summary(self):
+        return self._summary
+
+    def _on_evict(self, message):
+        with self._wakeup:
+            self._pending.append(message)
+            if len(self._pending) >= self.chunk_size:
+                self._ensure_worker()
+                self._wakeup.notify()
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run, name="Memory_Summarizing", daemon=True)
+            self._worker.start()
+
+    def _run(self):
+        while True:
+            with self._wakeup:
+                while len(self._pending) < self.chunk_size:
+                    self._busy = False
+                    self._wakeup.notify_all()
+                    self._wakeup.wait()
+                chunk = self._pending[:self.chunk_size]
+                self._busy = True
+            summary = error = None
+            try:
+                summary = self._summarize_chunk(self._summary, chunk)
+            except Exception as e:
+                log.exception(f"Summarization failed, will retry with the next eviction: {e}")
+                error = e
+            finally:
+                with self._wakeup:
+                    if error is not None:
+                        self._error = error
+                    # Chunk is removed only once summarized, clear() may have emptied pending list meanwhile
+                    elif summary is not None and self._pending[:len(chunk)] == chunk:
+                        del self._pending[:len(chunk)]
+                        self._summary = summary
+                        self._error = None
+                    self._busy = False
+                    self._wakeup.notify_all()
+                    if error is not None:
+                        self._wakeup.wait()
+
+    def chunk_key(self, summary, chunk):
+        data = json.dumps([summary, [(message.__class__.__name__, message.name, message.text) for message in chunk]], ensure_ascii=False)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def _summarize_chunk(self, summary, chunk):
+        key = self.chunk_key(summary, chunk)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+        if cached is not None:
+            return cached
+
+        request_messages = [
+            SystemMessage(self.summarize_instruction),
+            UserMessage(f"Existing summary:\n{summary or '(empty)'}\n\nNew messages:\n{messages_to_plaintext(chunk)}"),
+        ]
+        from ai_core.integrations import ChatAPI
+        if isinstance(self.completion, ChatAPI):
+            new_summary = self.completion(request_messages, dict(self.summary_parameters)).text
+        else:
+            from ai_core.templating import messages_to_prompt
+            prompt = messages_to_prompt(request_messages, template_name=self.template_name)
+            new_summary = self.completion(prompt, dict(self.summary_parameters))
+        new_summary = new_summary.strip()
+
+        with self._lock:
+            self._set_cache(key, new_summary)
+            self._append_cache(key, new_summary)
+        return new_summary
+
+    def _set_cache(self, key, summary):
+        self._cache[key] = summary
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.summary_cache_size:
+            self._cache.popitem(last=False)
+
+    def _load_cache(self):
+        if not self.summary_cache_path or not os.path.exists(self.summary_cache_path):
+            return
+        try:
+            with open(self.summary_cache_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    self._cache_file_entries += 1
+                    if set(entry) == {"key", "summary"}:
+                        self._set_cache(entry["key"], entry["summary"])
+                    else:
+                        # Single JSON object written by earlier versions
+                        for key, summary in entry.items():
+                            self._set_cache(key, summary)
+        except Exception as e:
+            log.warning(f"Unable to read summary cache {self.summary_cache_path}: {e}")
+        if self._cache_file_entries > 2 * self.summary_cache_size:
+            self._compact_cache()
+
+    def _append_cache(self, key, summary):
+        """Appends one entry to the cache file, which is rewritten with the cached entries only once it grows too large."""
+        if not self.summary_cache_path:
+            return
+        if self._cache_file_entries >= 2 * self.summary_cache_size:
+            self._compact_cache()
+            return
+        try:
+            with open(self.summary_cache_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"key": key, "summary": summary}, ensure_ascii=False) + "\n")
+            self._cache_file_entries += 1
+        except Exception as e:
+            log.warning(f"Unable to save summary cache {self.summary_cache_path}: {e}")
+
+    def _compact_cache(self):
+        try:
+            tmp_path = f"{self.summary_cache_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for key, summary in self._cache.items():
+                    f.write(json.dumps({"key": key, "summary": summary}, ensure_ascii=False) + "\n")
+            os.replace(tmp_path, self.summary_cache_path)
+            self._cache_file_entries = len(self._cache)
+        except Exception as e:
+            log.warning(f"Unable to save summary cache {self.summary_cache_path}: {e}")
+
+    def wait(self, timeout=None):
+        """
+        Blocks until all complete chunks of evicted messages are summarized. Returns False on timeout,
+        raises the error if summarization failed (the chunk is retried with the next eviction).
+        """
+        with self._wakeup:
+            if len(self._pending) >= self.chunk_size:
+                # Also retries a chunk which failed before
+                self._ensure_worker()
+                self._wakeup.notify_all()
+            done = self._wakeup.wait_for(
+                lambda: self._error is not None or (not self._busy and len(self._pending) < self.chunk_size),
+                timeout=timeout,
+            )
+            error, self._error = self._error, None
+        if error is not None:
+            raise error
+        return done
+
+    @property
+    def messages(self):
+        messages = super().messages
+        summary = self._summary
+        if summary:
+            from ai_core.templating import render_template_string
+            messages.insert(len(self.pinned_messages), SystemMessage(render_template_string(self.summary_template, {"summary": summary})))
+        return messages
+
+    def clear(self):
+        with self._wakeup:
+            self._pending = []
+            self._summary = ""
+            self._error = None
+        super().clear()
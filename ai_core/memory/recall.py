@@ -0,0 +1,272 @@
+"""
+Long-term recall: messages and knowledge entries are embedded into a vector index,
+and the most relevant ones are injected into the sliding window.
+"""
+import re
+import threading
+import zlib
+from typing import Any, List, Optional
+
+import numpy as np
+from loguru import logger as log
+from pydantic import PrivateAttr
+
+from ai_core.memory import SystemMessage, Memory_SlidingWindow
+
+
+class Embedder():
+    """Turns texts into L2-normalized float32 vectors."""
+    dim = 0
+
+    def embed(self, texts) -> np.ndarray:
+        raise NotImplementedError()
+
+
+class HashingEmbedder(Embedder):
+    """
+    CPU-friendly local embedder with no model: words and word bigrams are hashed into `dim` buckets (signed feature
+    hashing) with log-scaled term frequency. Captures lexical similarity only, but is fast and deterministic.
+    """
+    WORD = re.compile(r"\w+")
+
+    def __init__(self, dim=512, bigrams=True) -> None:
+        self.dim = dim
+        self.bigrams = bigrams
+
+    def _features(self, text):
+        words = self.WORD.findall(text.lower())
+        features = words
+        if self.bigrams:
+            features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+        return features
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        dim = self.dim
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                h = zlib.crc32(feature.encode("utf-8"))
+                vectors[row, h % dim] += 1.0 if (h >> 31) & 1 else -1.0
+        vectors = np.sign(vectors) * np.log1p(np.abs(vectors))
+        return _normalize(vectors)
+
+
+class SentenceTransformerEmbedder(Embedder):
+    """Embeds with a `sentence-transformers` model, loaded on creation."""
+
+    def __init__(self, model_id="sentence-transformers/all-MiniLM-L6-v2", batch_size=64, device=None) -> None:
+        from sentence_transformers import SentenceTransformer
+        log.info(f"Loading embedding model: {model_id}")
+        self.model = SentenceTransformer(model_id, device=device)
+        self.batch_size = batch_size
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def embed(self, texts):
+        vectors = self.model.encode(list(texts), batch_size=self.batch_size, convert_to_numpy=True, normalize_embeddings=True)
+        return vectors.astype(np.float32, copy=False)
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32, copy=False)
+
+
+class VectorIndex():
+    """
+    Exact cosine similarity index over normalized vectors, kept in one contiguous float32 matrix
+    (capacity doubles as it grows). Queries are scored in batches with a single matrix product.
+    """
+    def __init__(self, dim) -> None:
+        self.dim = dim
+        self.items = []
+        self._vectors = np.zeros((0, dim), dtype=np.float32)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def reset(self):
+        """Removes all vectors, keeps index configuration."""
+        with self._lock:
+            self.items = []
+            self._vectors = np.zeros((0, self.dim), dtype=np.float32)
+            self._size = 0
+
+    @property
+    def vectors(self):
+        return self._vectors[:self._size]
+
+    def add(self, vectors, items):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        with self._lock:
+            needed = self._size + len(vectors)
+            if needed > len(self._vectors):
+                capacity = max(needed, 2 * len(self._vectors), 1024)
+                grown = np.zeros((capacity, self.dim), dtype=np.float32)
+                grown[:self._size] = self._vectors[:self._size]
+                self._vectors = grown
+            self._vectors[self._size:needed] = vectors
+            self._size = needed
+            self.items.extend(items)
+
+    def search(self, queries, k=5):
+        """
+        Returns, for every query vector, a list of (score, item) of the k most similar items, best first.
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        if self._size == 0:
+            return [[] for _ in range(len(queries))]
+        scores = queries @ self.vectors.T
+        return [self._top_k(row_scores, np.arange(self._size), k) for row_scores in scores]
+
+    def _top_k(self, scores, ids, k):
+        k = min(k, len(scores))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), self.items[ids[i]]) for i in top]
+
+
+class IVFVectorIndex(VectorIndex):
+    """
+    Approximate index for large corpora: vectors are clustered with k-means into `n_lists` lists,
+    a query is scored only against vectors of its `n_probe` closest clusters.
+    Clusters are trained once the index reaches `train_size` vectors, until then search is exact.
+    """
+    def __init__(self, dim, n_lists=256, n_probe=8, train_size=20000, iterations=10, seed=0) -> None:
+        super().__init__(dim)
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.train_size = train_size
+        self.iterations = iterations
+        self.seed = seed
+        self._rng = np.random.default_rng(seed)
+        self.centroids = None
+        self._assignments = np.zeros(0, dtype=np.int32)
+        self._lists = None
+
+    def reset(self):
+        """Removes all vectors and trained clusters, keeps index configuration."""
+        super().reset()
+        self._rng = np.random.default_rng(self.seed)
+        self.centroids = None
+        self._assignments = np.zeros(0, dtype=np.int32)
+        self._lists = None
+
+    def add(self, vectors, items):
+        start = self._size
+        super().add(vectors, items)
+        if self.centroids is None:
+            if self._size >= self.train_size:
+                self.train()
+            return
+        assignments = self._assign(self._vectors[start:self._size])
+        self._assignments = np.concatenate([self._assignments, assignments])
+        self._lists = None
+
+    def _assign(self, vectors):
+        return np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+
+    def train(self):
+        """Spherical k-means over a sample of indexed vectors."""
+        vectors = self.vectors
+        sample = vectors[self._rng.choice(len(vectors), size=min(len(vectors), self.n_lists * 64), replace=False)]
+        centroids = sample[self._rng.choice(len(sample), size=min(self.n_lists, len(sample)), replace=False)].copy()
+        for _ in range(self.iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(len(centroids)):
+                members = sample[assignments == c]
+                if len(members):
+                    centroids[c] = members.sum(axis=0)
+            centroids = _normalize(centroids)
+        self.centroids = centroids
+        self._assignments = self._assign(vectors)
+        self._lists = None
+        log.debug(f"Trained IVF index with {len(centroids)} lists over {len(vectors)} vectors")
+
+    def _inverted_lists(self):
+        if self._lists is None:
+            order = np.argsort(self._assignments, kind="stable")
+            bounds = np.searchsorted(self._assignments[order], np.arange(len(self.centroids) + 1))
+            self._lists = [order[bounds[c]:bounds[c + 1]] for c in range(len(self.centroids))]
+        return self._lists
+
+    def search(self, queries, k=5):
+        if self.centroids is None:
+            return super().search(queries, k)
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        lists = self._inverted_lists()
+        probes = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :self.n_probe]
+        results = []
+        for query, query_probes in zip(queries, probes):
+            ids = np.concatenate([lists[c] for c in query_probes])
+            results.append(self._top_k(self._vectors[ids] @ query, ids, k))
+        return results
+
+
+class Memory_Recall(Memory_SlidingWindow):
+    """
+    Sliding window memory with long-term recall. Every added message and knowledge entry is embedded into a vector
+    index; on read, `top_k` entries most similar to the last `query_messages` messages, which are not in the window
+    already, are injected as a system message after pinned messages.
+    """
+    embedder: Any = None
+    index: Any = None
+    top_k: int = 3
+    min_score: float = 0.1
+    query_messages: int = 2
+    recall_template: str = "Relevant memories:\n{{memories}}"
+
+    _in_window: Any = PrivateAttr(default=None)
+
+    def model_post_init(self, __context):
+        if self.embedder is None:
+            self.embedder = HashingEmbedder()
+        if self.index is None:
+            self.index = VectorIndex(self.embedder.dim)
+        if self.messages_all:
+            self.index.add(self.embedder.embed([message.text for message in self.messages_all]), list(self.messages_all))
+
+    def add_message(self, message):
+        super().add_message(message)
+        self.index.add(self.embedder.embed([message.text]), [message])
+
+    def add_messages(self, messages):
+        messages = list(messages)
+        for message in messages:
+            super().add_message(message)
+        if messages:
+            self.index.add(self.embedder.embed([message.text for message in messages]), messages)
+
+    def add_knowledge(self, texts: List[str]):
+        """Adds knowledge entries (e.g. lore, character facts), recalled the same way as messages."""
+        texts = list(texts)
+        if texts:
+            self.index.add(self.embedder.embed(texts), [SystemMessage(text, "Knowledge") for text in texts])
+
+    def recall(self, query: str, k: Optional[int] = None, exclude=()):
+        exclude = {id(message) for message in exclude}
+        k = k or self.top_k
+        results = self.index.search(self.embedder.embed([query]), k=k + len(exclude))[0]
+        return [(score, item) for score, item in results if id(item) not in exclude and score >= self.min_score][:k]
+
+    @property
+    def messages(self):
+        messages = super().messages
+        window = messages[len(self.pinned_messages):]
+        if not window or not len(self.index):
+            return messages
+        query = "\n".join(message.text for message in window[-self.query_messages:])
+        recalled = self.recall(query, exclude=window)
+        if recalled:
+            from ai_core.templating import render_template_string
+            memories = "\n".join(f"{item.name}: {item.text}" for _, item in recalled)
+            messages.insert(len(self.pinned_messages), SystemMessage(render_template_string(self.recall_template, {"memories": memories})))
+        return messages
+
+    def clear(self):
+        super().clear()
+        self.index.reset()
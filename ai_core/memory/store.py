@@ -0,0 +1,342 @@
+"""
+Append-only on-disk message log, used by `Memory_Persistent`.
+
+Data file is a sequence of records: header (type, tokenizer, name length, text length, token count) followed by UTF-8 name and text.
+Index file (`<path>.idx`) holds (offset, token count) of every record, so reopening a log reads only the index,
+and messages are decoded lazily from a memory-mapped data file. Tokenizer is a number of the line in `<path>.tokenizers`
+naming the tokenizer which produced the token count (0 - unknown).
+"""
+import mmap
+import os
+import struct
+import threading
+from array import array
+from collections import OrderedDict, deque
+from typing import List, Optional
+
+from pydantic import PrivateAttr
+from ai_core.memory import Message, SystemMessage, UserMessage, AIMessage, Memory_TokenWindow, messages_to_plaintext
+from ai_core.utils.tokenizers import tokenizer_id
+
+RECORD_HEADER = struct.Struct("<BBHII")
+MAX_TOKENIZERS = 255
+INDEX_ENTRY = struct.Struct("<QI")
+NO_TOKEN_COUNT = 0xFFFFFFFF
+MESSAGE_CLASSES = [Message, SystemMessage, UserMessage, AIMessage]
+_MESSAGE_CLASS_CODES = {message_class: code for code, message_class in enumerate(MESSAGE_CLASSES)}
+
+
+# Logs keep their files open while in use; the least recently used ones are closed beyond this limit,
+# so thousands of conversations can be opened without running out of file descriptors
+MAX_OPEN_LOGS = 128
+_open_logs = OrderedDict()
+_open_logs_lock = threading.Lock()
+
+
+def _register_open_log(message_log):
+    with _open_logs_lock:
+        _open_logs[message_log] = None
+        _open_logs.move_to_end(message_log)
+        if len(_open_logs) <= MAX_OPEN_LOGS:
+            return
+        for other in list(_open_logs):
+            if len(_open_logs) <= MAX_OPEN_LOGS:
+                break
+            # Logs busy in other threads are skipped, blocking here could deadlock
+            if other is message_log or not other._lock.acquire(blocking=False):
+                continue
+            try:
+                other._close_files()
+                del _open_logs[other]
+            finally:
+                other._lock.release()
+
+
+class MessageLog():
+    def __init__(self, path) -> None:
+        self.path = path
+        self.index_path = f"{path}.idx"
+        self.tokenizers_path = f"{path}.tokenizers"
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._data = None
+        self._index = None
+        self._mmap = None
+        self.offsets = array("Q")
+        self.token_counts = array("I")
+        self.tokenizers = []
+        self._lock = threading.RLock()
+        with self._lock:
+            self._load_tokenizers()
+            self._load_index()
+
+    def _open_files(self):
+        """Opens data and index files if they were released. Must be called with the lock held."""
+        if self._data is None:
+            self._data = open(self.path, "ab+")
+            self._index = open(self.index_path, "ab")
+        _register_open_log(self)
+
+    def _close_files(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._data is not None:
+            self._data.close()
+            self._index.close()
+            self._data = None
+            self._index = None
+
+    def _release_files(self):
+        self._close_files()
+        with _open_logs_lock:
+            _open_logs.pop(self, None)
+
+    def _load_tokenizers(self):
+        if os.path.exists(self.tokenizers_path):
+            with open(self.tokenizers_path, "r", encoding="utf-8") as f:
+                self.tokenizers = [line.rstrip("\n") for line in f if line.strip()]
+
+    def _tokenizer_code(self, tokenizer):
+        """Number of the tokenizer in `<path>.tokenizers`, new tokenizers are appended. 0 if unknown."""
+        if tokenizer is None:
+            return 0
+        if tokenizer in self.tokenizers:
+            return self.tokenizers.index(tokenizer) + 1
+        if len(self.tokenizers) >= MAX_TOKENIZERS or "\n" in tokenizer:
+            return 0
+        with open(self.tokenizers_path, "a", encoding="utf-8") as f:
+            f.write(tokenizer + "\n")
+        self.tokenizers.append(tokenizer)
+        return len(self.tokenizers)
+
+    def _load_index(self):
+        raw = b""
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as f:
+                raw = f.read()
+        offsets, token_counts = self.offsets, self.token_counts
+        for offset, token_count in INDEX_ENTRY.iter_unpack(raw[:len(raw) - len(raw) % INDEX_ENTRY.size]):
+            offsets.append(offset)
+            token_counts.append(token_count)
+
+        self._open_files()
+        # Entries pointing past the end of data (data write was lost) are dropped
+        data_size = os.fstat(self._data.fileno()).st_size
+        while offsets and offsets[-1] + RECORD_HEADER.size > data_size:
+            offsets.pop()
+            token_counts.pop()
+        while offsets and self._record_end(len(offsets) - 1) > data_size:
+            offsets.pop()
+            token_counts.pop()
+        # Torn or dropped trailing entries are cut off, so appended entries stay aligned
+        if len(raw) != len(offsets) * INDEX_ENTRY.size:
+            self._index.truncate(len(offsets) * INDEX_ENTRY.size)
+
+        # Records written after the last index entry (e.g. crash between writes) are recovered by scanning
+        position = self._record_end(len(offsets) - 1) if offsets else 0
+        while position + RECORD_HEADER.size <= data_size:
+            self._data.seek(position)
+            _, _, name_length, text_length, token_count = RECORD_HEADER.unpack(self._data.read(RECORD_HEADER.size))
+            end = position + RECORD_HEADER.size + name_length + text_length
+            if end > data_size:
+                break
+            self._append_index(position, token_count)
+            position = end
+        self._index.flush()
+
+    def _record_end(self, i):
+        self._data.seek(self.offsets[i])
+        _, _, name_length, text_length, _ = RECORD_HEADER.unpack(self._data.read(RECORD_HEADER.size))
+        return self.offsets[i] + RECORD_HEADER.size + name_length + text_length
+
+    def _append_index(self, offset, token_count):
+        self.offsets.append(offset)
+        self.token_counts.append(token_count)
+        self._index.write(INDEX_ENTRY.pack(offset, token_count))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append(self, message: Message, token_count: Optional[int] = None, tokenizer: Optional[str] = None):
+        self.extend([message], [token_count], [tokenizer])
+
+    def extend(self, messages, token_counts=None, tokenizers=None):
+        """Appends messages with their precomputed token counts (and ids of tokenizers which produced them) in one write."""
+        token_counts = token_counts or [None] * len(messages)
+        tokenizers = tokenizers or [None] * len(messages)
+        with self._lock:
+            self._open_files()
+            self._data.seek(0, os.SEEK_END)
+            offset = self._data.tell()
+            chunks = []
+            for message, token_count, tokenizer in zip(messages, token_counts, tokenizers):
+                name = message.name.encode("utf-8")
+                text = message.text.encode("utf-8")
+                code = _MESSAGE_CLASS_CODES.get(type(message), 0)
+                tokenizer_code = 0
+                if token_count is None:
+                    token_count = NO_TOKEN_COUNT
+                else:
+                    tokenizer_code = self._tokenizer_code(tokenizer)
+                chunks.append(RECORD_HEADER.pack(code, tokenizer_code, len(name), len(text), token_count))
+                chunks.append(name)
+                chunks.append(text)
+                self._append_index(offset, token_count)
+                offset += RECORD_HEADER.size + len(name) + len(text)
+            self._data.write(b"".join(chunks))
+            self._data.flush()
+            self._index.flush()
+
+    def _view(self, end):
+        if self._mmap is None or len(self._mmap) < end:
+            if self._mmap is not None:
+                self._mmap.close()
+            self._data.flush()
+            self._mmap = mmap.mmap(self._data.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def read(self, i) -> Message:
+        with self._lock:
+            self._open_files()
+            offset = self.offsets[i]
+            view = self._view(offset + RECORD_HEADER.size)
+            code, _, name_length, text_length, _ = RECORD_HEADER.unpack_from(view, offset)
+            start = offset + RECORD_HEADER.size
+            view = self._view(start + name_length + text_length)
+            name = view[start:start + name_length].decode("utf-8")
+            text = view[start + name_length:start + name_length + text_length].decode("utf-8")
+        message_class = MESSAGE_CLASSES[code] if code < len(MESSAGE_CLASSES) else Message
+        return message_class(text, name)
+
+    def record_tokenizer(self, i) -> Optional[str]:
+        """Id of the tokenizer which produced the stored token count of i-th message, None if unknown."""
+        with self._lock:
+            self._open_files()
+            offset = self.offsets[i]
+            tokenizer_code = self._view(offset + RECORD_HEADER.size)[offset + 1]
+        return self.tokenizers[tokenizer_code - 1] if 0 < tokenizer_code <= len(self.tokenizers) else None
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.read(j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        return self.read(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.read(i)
+
+    def tail_start(self, token_limit):
+        """Index of the first message of the newest messages which fit into token_limit, using stored token counts."""
+        would_be_count = 0
+        token_counts = self.token_counts
+        i = len(token_counts)
+        while i > 0:
+            token_count = token_counts[i - 1]
+            if token_count == NO_TOKEN_COUNT:
+                break
+            would_be_count += token_count
+            if would_be_count >= token_limit:
+                break
+            i -= 1
+        return i
+
+    def tail(self, token_limit) -> List[Message]:
+        return self[self.tail_start(token_limit):]
+
+    def truncate(self):
+        with self._lock:
+            self._open_files()
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+            self._data.truncate(0)
+            self._index.truncate(0)
+            self.offsets = array("Q")
+            self.token_counts = array("I")
+            self.tokenizers = []
+            if os.path.exists(self.tokenizers_path):
+                os.remove(self.tokenizers_path)
+
+    def close(self):
+        """Closes open files, they are reopened on the next access."""
+        with self._lock:
+            self._release_files()
+
+
+class Memory_Persistent(Memory_TokenWindow):
+    """
+    Token window memory backed by an append-only `MessageLog` at `path`. Messages are written with their token
+    counts as they are added; on open only the index is read and just the window tail is decoded.
+    Messages falling out of the window are dropped from RAM, the full history is available as `history`.
+    Stored token counts are reused only if they were produced by the same tokenizer, otherwise messages are recounted.
+    `messages_all` given on creation is appended to a new log, giving it along with an existing history is an error.
+    """
+    path: str
+    _store: Optional[MessageLog] = PrivateAttr(default=None)
+
+    def model_post_init(self, __context):
+        self._store = MessageLog(self.path)
+        if self.messages_all:
+            if len(self._store):
+                raise ValueError(f"Message log {self.path} already has history, can't add messages_all to it")
+            messages = list(self.messages_all)
+            self._store.extend(
+                messages,
+                [message.count_tokens(self.tokenizer) for message in messages],
+                [self._count_tokens_id(message) for message in messages],
+            )
+        super().model_post_init(__context)
+
+    @property
+    def history(self) -> MessageLog:
+        return self._store
+
+    def _count_tokens_id(self, message):
+        return tokenizer_id(self.tokenizer or type(message).count_tokens_func)
+
+    def _read_counted(self, i):
+        """Reads i-th message of the log, seeding its token count if it was stored by the current tokenizer."""
+        store = self._store
+        message = store.read(i)
+        token_count = store.token_counts[i]
+        if token_count != NO_TOKEN_COUNT and store.record_tokenizer(i) == self._count_tokens_id(message):
+            count_tokens_func = self.tokenizer or type(message).count_tokens_func
+            message._token_count = (count_tokens_func, message.text, message.name, token_count)
+        return message
+
+    def _rebuild_window(self):
+        store = self._store
+        tail = deque(maxlen=self.keep_max or None)
+        would_be_count = 0
+        for i in range(len(store) - 1, -1, -1):
+            if len(tail) == tail.maxlen:
+                break
+            message = self._read_counted(i)
+            would_be_count += message.count_tokens(self.tokenizer)
+            if would_be_count >= self.token_limit:
+                break
+            tail.appendleft(message)
+        self.messages_all = tail
+        super()._rebuild_window()
+
+    def add_message(self, message):
+        self._store.append(message, message.count_tokens(self.tokenizer), self._count_tokens_id(message))
+        super().add_message(message)
+
+    def _on_evict(self, message):
+        # Evicted message is the oldest one kept in RAM, history stays on disk
+        if self.messages_all and self.messages_all[0] is message:
+            self.messages_all.popleft()
+
+    def to_plaintext_all(self):
+        return messages_to_plaintext(self._store)
+
+    def clear(self):
+        self._store.truncate()
+        super().clear()
+
+    def close(self):
+        self._store.close()
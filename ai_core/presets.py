@@ -1,7 +1,11 @@
 import yaml
 import os
+import threading
+from collections.abc import Mapping
+from types import MappingProxyType
 from loguru import logger as log
 AI_CORE_DIR = os.path.dirname(os.path.realpath(__file__))
+PRESETS_DIR = os.path.join(AI_CORE_DIR, "presets")
 
 def load_preset_string(yaml_string: str):
     return yaml.safe_load(yaml_string)
@@ -9,10 +13,157 @@ def load_preset_string(yaml_string: str):
 def load_preset_file(filepath: str):
     with open(filepath, "r", encoding="utf-8") as f:
         return yaml.safe_load(f.read())
-    
+
+
+class _FrozenDict(dict):
+    """Read-only dict for nested preset values, still serializable to JSON as a request payload."""
+    __slots__ = ()
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("Preset parameters are read-only, use Preset.override() or Preset.to_dict()")
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        return (_FrozenDict, (dict(self),))
+
+
+def _freeze(value):
+    """Nested lists and dicts become tuples and read-only dicts, so shared presets can't be changed in place."""
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, Mapping):
+        return _FrozenDict((key, _freeze(item)) for key, item in value.items())
+    if isinstance(value, set):
+        return frozenset(value)
+    return value
+
+def _thaw(value):
+    """Reverse of `_freeze`, returns new mutable lists and dicts."""
+    if isinstance(value, tuple):
+        return [_thaw(item) for item in value]
+    if isinstance(value, Mapping):
+        return {key: _thaw(item) for key, item in value.items()}
+    if isinstance(value, frozenset):
+        return set(value)
+    return value
+
+
+class Preset(Mapping):
+    """
+    Immutable set of generation parameters. Overrides and layers create new presets,
+    so cached presets can be shared safely. Use `to_dict()` to get a payload for a request.
+    """
+    __slots__ = ("name", "_parameters", "_validated")
+
+    def __init__(self, parameters=None, name=None) -> None:
+        self.name = name
+        self._parameters = MappingProxyType({key: _freeze(value) for key, value in (parameters or {}).items()})
+        self._validated = {}
+
+    def __getitem__(self, key):
+        return self._parameters[key]
+
+    def __iter__(self):
+        return iter(self._parameters)
+
+    def __len__(self):
+        return len(self._parameters)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.name!r}, {dict(self._parameters)})"
+
+    def override(self, parameters=None, **kwargs) -> "Preset":
+        """Returns new preset with given parameters replaced. Keys with None values are removed."""
+        changes = dict(parameters or {}, **kwargs)
+        if not changes:
+            return self
+        merged = dict(self._parameters)
+        for key, value in changes.items():
+            if value is None:
+                merged.pop(key, None)
+            else:
+                merged[key] = value
+        return Preset(merged, name=self.name)
+
+    def layer(self, *layers) -> "Preset":
+        """Applies layers (mappings, lowest priority first) on top of this preset."""
+        preset = self
+        for layer in layers:
+            if layer:
+                preset = preset.override(layer)
+        return preset
+
+    def validate(self, allowed_keys) -> "Preset":
+        """
+        Returns preset without keys the backend doesn't accept (e.g. `client.get_allowed_payload_keys()`).
+        Result is cached per set of allowed keys, so it can be done once instead of on every request.
+        """
+        allowed_keys = frozenset(allowed_keys)
+        validated = self._validated.get(allowed_keys)
+        if validated is None:
+            unknown_keys = [key for key in self._parameters if key not in allowed_keys]
+            if unknown_keys:
+                log.warning(f"Preset '{self.name}' has parameters not supported by the backend: {unknown_keys}")
+                validated = Preset({key: value for key, value in self._parameters.items() if key in allowed_keys}, name=self.name)
+            else:
+                validated = self
+            self._validated[allowed_keys] = validated
+        return validated
+
+    def to_dict(self) -> dict:
+        """Returns parameters as a new dict, nested values are copied too."""
+        return {key: _thaw(value) for key, value in self._parameters.items()}
+
+
+class PresetRegistry():
+    """
+    Loads presets from presets/*.yaml once, a preset is reloaded if its file was modified.
+    """
+    def __init__(self, directory=PRESETS_DIR) -> None:
+        self.directory = directory
+        self._presets = {}
+        self._lock = threading.Lock()
+
+    def filepath(self, preset_name):
+        return os.path.join(self.directory, preset_name + ".yaml")
+
+    def names(self):
+        return sorted(os.path.splitext(filename)[0] for filename in os.listdir(self.directory) if filename.endswith(".yaml"))
+
+    def load_all(self):
+        """Loads all presets ahead of time, e.g. at startup."""
+        return {preset_name: self.get(preset_name) for preset_name in self.names()}
+
+    def get(self, preset_name) -> Preset:
+        filepath = self.filepath(preset_name)
+        mtime = os.stat(filepath).st_mtime_ns
+        cached = self._presets.get(preset_name)
+        if cached is None or cached[0] != mtime:
+            with self._lock:
+                cached = (mtime, Preset(load_preset_file(filepath), name=preset_name))
+                self._presets[preset_name] = cached
+        return cached[1]
+
+    def parameters(self, preset_name, model_name=None, overrides=None, allowed_keys=None) -> Preset:
+        """
+        Layers preset, defaults of the model from model_templates.yaml (stop strings, `parameters`)
+        and per-request overrides. If `allowed_keys` is given, parameters the backend doesn't accept are dropped.
+        """
+        preset = self.get(preset_name)
+        if model_name is not None:
+            from ai_core.utils.models import model_registry
+            preset = preset.layer(model_registry.get(model_name).default_parameters)
+        preset = preset.layer(overrides)
+        if allowed_keys is not None:
+            preset = preset.validate(allowed_keys)
+        return preset
+
+preset_registry = PresetRegistry()
+
 def load_preset(preset_name: str):
-    filepath = os.path.join(AI_CORE_DIR, "presets", preset_name + ".yaml")
-    if not os.path.exists(filepath):
-        log.error(f"Preset '{preset_name}' not found at {filepath}!")
+    """Returns preset parameters as a new dict, which can be modified freely."""
+    if not os.path.exists(preset_registry.filepath(preset_name)):
+        log.error(f"Preset '{preset_name}' not found at {preset_registry.filepath(preset_name)}!")
         return {}
-    return load_preset_file(filepath)
\ No newline at end of file
+    return preset_registry.get(preset_name).to_dict()
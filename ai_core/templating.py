@@ -1,4 +1,7 @@
 import os
+import threading
+from functools import lru_cache
+from cachetools import LRUCache
 from ai_core import APP_DIR
 from jinja2 import Environment, BaseLoader
 from ai_core.memory import Message, SystemMessage, UserMessage, AIMessage
@@ -6,10 +9,19 @@ from typing import List
 from loguru import logger as log
 import yaml
 
+CHAT_TEMPLATES_DIR = os.path.join(APP_DIR, "templates", "chat")
+
+# Single shared environment, building one per render is expensive
+_env = Environment(autoescape=False, loader=BaseLoader, trim_blocks=True, lstrip_blocks=True, keep_trailing_newline=True)
+
+@lru_cache(maxsize=512)
+def compile_template_string(template_string):
+    """Compiles template string into reusable jinja2 Template. Compiled templates are cached."""
+    return _env.from_string(template_string)
+
 def render_template_string(template_string, context, ignore_errors=False):
     try:
-        env = Environment(autoescape=False, loader=BaseLoader, trim_blocks=True, lstrip_blocks=True, keep_trailing_newline=True)
-        rtemplate = env.from_string(template_string)
+        rtemplate = compile_template_string(template_string)
         return rtemplate.render(**context)
     except Exception as e:
         if ignore_errors:
@@ -33,28 +45,141 @@ class SystemMessageTemplate():
     
     def format(self, **context):
         return render_template_string(self.template_string, context=context)
-    
+
+
+class PromptFormat():
+    """
+    Chat prompt format (one of templates/chat/*.yaml) with all templates compiled once.
+    """
+    MESSAGE_TYPES = ("SystemMessage", "UserMessage", "AIMessage")
+
+    def __init__(self, name, config, mtime=None) -> None:
+        self.name = name
+        self.mtime = mtime
+        self.prefix = config.get('prefix') or ""
+        self.suffix = compile_template_string(config.get('suffix') or "")
+        self.message_templates = {
+            message_type: compile_template_string(config[message_type])
+            for message_type in self.MESSAGE_TYPES if message_type in config
+        }
+        self._templates_by_class = {}
+
+    @classmethod
+    def from_file(cls, filepath, name=None):
+        mtime = os.stat(filepath).st_mtime_ns
+        with open(filepath, "r", encoding="utf-8") as f:
+            config = yaml.safe_load(f.read())
+        name = name or os.path.splitext(os.path.basename(filepath))[0]
+        return cls(name, config, mtime=mtime)
+
+    def template_for(self, message):
+        """Returns compiled template for a message, resolved by message class (and its parents)."""
+        message_class = type(message)
+        template = self._templates_by_class.get(message_class)
+        if template is None:
+            for klass in message_class.__mro__:
+                if klass.__name__ in self.message_templates:
+                    template = self.message_templates[klass.__name__]
+                    break
+            else:
+                template = compile_template_string(f"UNKNOWN MESSAGE TYPE: {str(message_class)}")
+            self._templates_by_class[message_class] = template
+        return template
+
+    def render_message(self, message):
+        return self.template_for(message).render(message=message)
+
+    def render_suffix(self, next_message_name=None):
+        return self.suffix.render(next_message_name=next_message_name)
+
+    def render(self, messages, next_message_name=None):
+        parts = [self.prefix]
+        parts.extend(self.render_message(message) for message in messages)
+        parts.append(self.render_suffix(next_message_name))
+        return "".join(parts)
+
+
+class PromptFormatRegistry():
+    """
+    Loads chat prompt formats once and keeps them compiled. A format is reloaded if its file was modified.
+    """
+    def __init__(self, directory=CHAT_TEMPLATES_DIR) -> None:
+        self.directory = directory
+        self._formats = {}
+        self._lock = threading.Lock()
+
+    def filepath(self, template_name):
+        return os.path.join(self.directory, f"{template_name}.yaml")
+
+    def get(self, template_name) -> PromptFormat:
+        filepath = self.filepath(template_name)
+        mtime = os.stat(filepath).st_mtime_ns
+        prompt_format = self._formats.get(template_name)
+        if prompt_format is None or prompt_format.mtime != mtime:
+            with self._lock:
+                prompt_format = self._formats.get(template_name)
+                if prompt_format is None or prompt_format.mtime != mtime:
+                    log.debug(f"Loading prompt format '{template_name}' from {filepath}")
+                    prompt_format = PromptFormat.from_file(filepath, name=template_name)
+                    self._formats[template_name] = prompt_format
+        return prompt_format
+
+    def clear(self):
+        with self._lock:
+            self._formats = {}
+
+prompt_formats = PromptFormatRegistry()
+
+
+class PromptRenderCache():
+    """
+    Memoizes rendered message fragments, keyed by prompt format and message type, name and text.
+    On each chat turn only new (or edited) messages are rendered, the rest of the prompt is joined from cache.
+    """
+    def __init__(self, maxsize=8192, registry=None) -> None:
+        self.registry = registry or prompt_formats
+        self.fragments = LRUCache(maxsize=maxsize)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def render(self, messages, template_name='chatml', next_message_name=None):
+        prompt_format = self.registry.get(template_name)
+        format_key = (prompt_format.name, prompt_format.mtime)
+        parts = [prompt_format.prefix]
+        for message in messages:
+            key = (format_key, type(message), message.name, message.text)
+            with self._lock:
+                fragment = self.fragments.get(key)
+            if fragment is None:
+                fragment = prompt_format.render_message(message)
+                with self._lock:
+                    self.fragments[key] = fragment
+                    self.misses += 1
+            else:
+                self.hits += 1
+            parts.append(fragment)
+        parts.append(prompt_format.render_suffix(next_message_name))
+        return "".join(parts)
+
+    def clear(self):
+        with self._lock:
+            self.fragments.clear()
+            self.hits = 0
+            self.misses = 0
+
+prompt_render_cache = PromptRenderCache()
+
 # llama3-instruct
 # chatml
-def messages_to_prompt(messages:List[Message], config=None, template_name='chatml', next_message_name=None):
+def messages_to_prompt(messages:List[Message], config=None, template_name='chatml', next_message_name=None, render_cache=None):
+    """Renders messages into a prompt. Pass `render_cache` (e.g. `prompt_render_cache`) to reuse fragments rendered on previous turns."""
     if callable(template_name):
         template_name = template_name()
-    config_filepath = os.path.join(APP_DIR, "templates", "chat", f"{template_name}.yaml")
-    with open(config_filepath, "r", encoding="utf-8") as f:
-        config = yaml.safe_load(f.read())
-
-    text = config['prefix']
-    for message in messages:
-        if isinstance(message, AIMessage):
-            t = config['AIMessage']
-        elif isinstance(message, UserMessage):
-            t = config['UserMessage']
-        elif isinstance(message, SystemMessage):
-            t = config['SystemMessage']
-        else:
-            t = f"UNKNOWN MESSAGE TYPE: {str(type(message))}"
-        text += render_template_string(t, context={"message": message})
-    text += render_template_string(config['suffix'], context={"next_message_name": next_message_name})
+    if render_cache is not None:
+        text = render_cache.render(messages, template_name=template_name, next_message_name=next_message_name)
+    else:
+        text = prompt_formats.get(template_name).render(messages, next_message_name=next_message_name)
 
     log.debug(f"Messages to Prompt:\n{text}")
-    return text
\ No newline at end of file
+    return text
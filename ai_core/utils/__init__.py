@@ -1,10 +1,16 @@
-import re, os, yaml
-from ai_core import APP_DIR
+import re, yaml
 from loguru import logger as log
+import threading
+from typing import List, NamedTuple
 import requests
-from urllib.parse import urljoin
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlparse
+from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
+from ai_core.utils.tokenizers import get_tokenizer
+from ai_core.utils.models import model_registry, MODEL_TEMPLATES_FILEPATH
 
-model_templates_config_fp = os.path.join(APP_DIR, "model_templates.yaml")
+model_templates_config_fp = MODEL_TEMPLATES_FILEPATH
 
 def read_config():
     with open(model_templates_config_fp, "r", encoding="utf-8") as f:
@@ -25,33 +31,26 @@ def untokenize(tokens):
     return text
 
 
-def trim_text_by_tokens(text, max_tokens, from_start=True):
+def trim_text_by_tokens(text, max_tokens, from_start=True, tokenizer=None):
     """Trims text to fit into max_tokens length.
 
     Args:
         text (str): Input text
         max_tokens (int): Maximum amount of tokens
-        from_start (bool, optional): Where to start cutting text from. If True - will cut from beginning, leaving the ending part of the text. If False will cut from beginning. Defaults to True.
+        from_start (bool, optional): Where to start cutting text from. If True - will cut from beginning, leaving the ending part of the text. If False will cut from the end. Defaults to True.
+        tokenizer (optional): Tokenizer backend or its name (see `ai_core.utils.tokenizers.get_tokenizer`). Defaults to NLTK.
 
     Returns:
-        _type_: _description_
+        str: Trimmed text, a slice of the original text (newlines and formatting are preserved)
     """
     if isinstance(text, list):
         text = " ".join(text)
-    text = text.replace("\n", r"<llbr>")
-    tokens = tokenize(text)
-    if len(tokens) <= max_tokens:
-        return text.replace("<llbr>", "\n").replace("llbr>", "\n").replace("<llbr", "\n")
+    return get_tokenizer(tokenizer).trim_text(text, max_tokens, from_start=from_start)
 
-    # Adding one just in case to make sure we are UNDER the limit. Maybe it's rudimentary.
-    trim_tokens_count = len(tokens) - max_tokens + 1
-
-    if from_start:
-        trimmed = untokenize(tokens[trim_tokens_count:])
-    else:
-        trimmed = untokenize(tokens[:len(tokens) - trim_tokens_count])
-    trimmed = str(trimmed).replace("<llbr>", "\n").replace("llbr>", "\n").replace("<llbr", "\n")
-    return trimmed
+def trim_texts_by_tokens(texts, max_tokens, from_start=True, tokenizer=None):
+    """Same as `trim_text_by_tokens`, for many texts at once (a single batched call for HuggingFace tokenizers)."""
+    texts = [" ".join(text) if isinstance(text, list) else text for text in texts]
+    return get_tokenizer(tokenizer).trim_texts(texts, max_tokens, from_start=from_start)
 
 def count_tokens_nltk(*args):
     return len(tokenize(*args))
@@ -73,73 +72,170 @@ def trim_incomplete_sentence(txt):
     return txt
 
 def get_config_from_model_name(model_name):
-    model_templates_config = read_config()
-    for regex, model_config in model_templates_config.items():
-        if re.match(regex, model_name, re.IGNORECASE):
-            log.debug(
-                f"Found matching model config: {model_name} (REGEX: {regex})"
-            )
-            return model_config
-    raise Exception(f"Unable to find matching config for model: {model_name}")
+    """Returns model config as a dict, see `ai_core.utils.models.model_registry` for typed configs."""
+    return model_registry.get(model_name).to_dict()
 
 def get_prompt_format_from_model_name(model_name):
-    model_config = get_config_from_model_name(model_name)
-    return model_config['prompt_format']
+    return model_registry.get(model_name).prompt_format
+
+
+ATTACHMENT_URL_PATTERN = r"\(?\/Content\/Attachments\/.*?(?: |\))"
+URL_PATTERN = r"(?:http[s]?:\/\/.)?(?:www\.)?[-a-zA-Z0-9@%._\+~#=]{2,256}\.[a-z]{2,6}\b(?:[-a-zA-Z0-9@:%_\+.~#?&\/\/=]*)"
+# Attachments are tried first at every position, so general urls never match inside them
+URL_RE = re.compile("(?P<attachment>" + ATTACHMENT_URL_PATTERN + ")|(?P<url>" + URL_PATTERN + ")")
+
+
+class UrlMatch(NamedTuple):
+    start: int
+    end: int
+    # Url as it appears in text
+    raw: str
+    # Absolute url
+    url: str
+
+
+def find_urls(text, base_site=None) -> List[UrlMatch]:
+    """Finds urls in a single pass, returns them with spans of raw urls in text."""
+    matches = []
+    for match in URL_RE.finditer(text):
+        start, end = match.span()
+        if match.lastgroup == "attachment":
+            # Strip enclosing brackets and trailing space from the span
+            if text[start] == "(":
+                start += 1
+            if text[end - 1] in " )":
+                end -= 1
+        raw = text[start:end]
+        url = raw
+        if base_site is not None and not raw.startswith(("http://", "https://")):
+            url = urljoin(base_site, raw)
+        matches.append(UrlMatch(start, end, raw, url))
+    return matches
 
 
 def extract_urls(text, base_site=None):
-    regex = r"(?:|\()\/Content\/Attachments\/.*?(?: |\))"
-    urls = re.findall(regex, text)
-    print(urls)
-    for url in urls:
-        text = text.replace(url, "")
-    regex = r"(?:http[s]?:\/\/.)?(?:www\.)?[-a-zA-Z0-9@%._\+~#=]{2,256}\.[a-z]{2,6}\b(?:[-a-zA-Z0-9@:%_\+.~#?&\/\/=]*)"
-    urls.extend(re.findall(regex, text))
-    print(urls)
-    urls = [url.replace("(", "").replace(")", "").replace("\n", "") for url in urls]
-    extracted_urls = []
-    if base_site is not None:
-        for url in urls:
-            if url.startswith(("http://", "https://")):  # Handle URLs starting with http or https
-                extracted_urls.append(url)
-            else:  # Handle relative URLs
-                full_url = urljoin(base_site, url)
-                extracted_urls.append(full_url)
-    else:
-        extracted_urls = urls
-    print(extracted_urls, urls)
-    return extracted_urls, urls
-
-
-def is_image_url(url):
-    print(f"Testing if {url} is image...")
+    matches = find_urls(text, base_site=base_site)
+    return [match.url for match in matches], [match.raw for match in matches]
+
+
+def replace_spans(text, replacements):
+    """
+    Rebuilds text in one pass, replacing (start, end, replacement) spans. Spans must not overlap.
+    """
+    parts = []
+    position = 0
+    for start, end, replacement in sorted(replacements, key=lambda item: item[0]):
+        parts.append(text[position:start])
+        parts.append(replacement)
+        position = end
+    parts.append(text[position:])
+    return "".join(parts)
+
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".webp", ".bmp", ".tif", ".tiff", ".avif")
+# Paths that always serve images (chat attachments), so they are never probed
+IMAGE_PATHS = ("/Content/Attachments/",)
+IMAGE_PROBE_TIMEOUT = (3.05, 10)
+IMAGE_PROBE_MAX_WORKERS = 8
+
+# Probe results (image or not) are cached per url. Failed probes (network errors, 5xx) are cached for a shorter time,
+# so unreachable urls are not probed on every call, but temporary errors are retried
+_image_url_cache = TTLCache(maxsize=4096, ttl=3600)
+_failed_image_url_cache = TTLCache(maxsize=4096, ttl=60)
+_image_url_cache_lock = threading.Lock()
+_image_probe_session = None
+
+
+def get_image_probe_session():
+    global _image_probe_session
+    if _image_probe_session is None:
+        with _image_url_cache_lock:
+            if _image_probe_session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=IMAGE_PROBE_MAX_WORKERS, pool_maxsize=IMAGE_PROBE_MAX_WORKERS)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _image_probe_session = session
+    return _image_probe_session
+
+
+def _guess_is_image_url(url):
+    """Returns True/False when url type is known without a request, None otherwise."""
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https"):
+        return False
+    path = parsed.path
+    if path.lower().endswith(IMAGE_EXTENSIONS) or path.startswith(IMAGE_PATHS):
+        return True
+    return None
+
+
+def _probe_is_image_url(url, timeout=IMAGE_PROBE_TIMEOUT, session=None):
+    """Returns (is image, reachable). Url is not reachable on network errors and server errors."""
+    session = session or get_image_probe_session()
     try:
-        response = requests.head(url, timeout=30)
+        response = session.head(url, timeout=timeout, allow_redirects=True)
+        if response.status_code >= 500:
+            return False, False
         if not response:
-            return False
+            return False, True
         content_type = response.headers.get('content-type')
-        # print(conten)
-        if content_type is not None and 'image' in content_type:
-            return True
-        return False
-    except Exception as e:
-        print(e)
-        return False
-    
-def extract_image_urls(text, base_site=None):
+        return content_type is not None and 'image' in content_type, True
+    except requests.RequestException as e:
+        log.debug(f"Failed to probe {url}: {e}")
+        return False, False
+
+
+def is_image_url(url, timeout=IMAGE_PROBE_TIMEOUT, session=None, use_cache=True):
+    guess = _guess_is_image_url(url)
+    if guess is not None:
+        return guess
+    if use_cache:
+        with _image_url_cache_lock:
+            if url in _image_url_cache:
+                return _image_url_cache[url]
+            if url in _failed_image_url_cache:
+                return False
+    is_image, reachable = _probe_is_image_url(url, timeout=timeout, session=session)
+    if use_cache:
+        with _image_url_cache_lock:
+            if reachable:
+                _image_url_cache[url] = is_image
+            else:
+                _failed_image_url_cache[url] = False
+    return is_image
+
+
+def classify_image_urls(urls, max_workers=IMAGE_PROBE_MAX_WORKERS, timeout=IMAGE_PROBE_TIMEOUT):
+    """
+    Returns {url: is_image} for given urls. Each unique url is checked once, urls which can not be classified
+    by extension or cache are probed concurrently.
+    """
+    unique_urls = list(dict.fromkeys(urls))
+    if len(unique_urls) <= 1 or max_workers <= 1:
+        return {url: is_image_url(url, timeout=timeout) for url in unique_urls}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(unique_urls))) as executor:
+        results = executor.map(lambda url: is_image_url(url, timeout=timeout), unique_urls)
+        return dict(zip(unique_urls, results))
+
+
+def find_image_urls(text, base_site=None, max_workers=IMAGE_PROBE_MAX_WORKERS):
+    """Returns (image url matches, non image url matches), see `find_urls`."""
+    matches = find_urls(text, base_site=base_site)
+    classified = classify_image_urls([match.url for match in matches], max_workers=max_workers)
+    image_matches = [match for match in matches if classified[match.url]]
+    non_image_matches = [match for match in matches if not classified[match.url]]
+    return image_matches, non_image_matches
+
+
+def extract_image_urls(text, base_site=None, max_workers=IMAGE_PROBE_MAX_WORKERS):
     """
     Raw urls are urls as they appear in text
     urls are absolute urls, which were converted if they were not absolute"""
-    image_urls = []
-    raw_image_urls = []
-    non_image_urls = []
-    raw_non_image_urls = []
-    urls, raw_urls = extract_urls(text, base_site=base_site)
-    for i, url in enumerate(urls):
-        if is_image_url(url):
-            image_urls.append(url)
-            raw_image_urls.append(raw_urls[i])
-        else:
-            non_image_urls.append(url)
-            raw_non_image_urls.append(raw_urls[i])
-    return image_urls, raw_urls, non_image_urls, raw_non_image_urls
\ No newline at end of file
+    image_matches, non_image_matches = find_image_urls(text, base_site=base_site, max_workers=max_workers)
+    return (
+        [match.url for match in image_matches],
+        [match.raw for match in image_matches],
+        [match.url for match in non_image_matches],
+        [match.raw for match in non_image_matches],
+    )
@@ -0,0 +1,218 @@
+"""
+Cache of downloaded images for `ai_core.utils.vision`.
+
+Decoded images are kept in memory in LRU order with a TTL, bounded by the total size of decoded pixel data.
+Concurrent requests for the same url share a single download. Optionally, the encoded (downloaded) bytes
+are also stored on disk, so restarts do not download images again.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from io import BytesIO
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image
+from loguru import logger as log
+
+DEFAULT_IMAGE_CACHE_DIR = os.environ.get("AI_CORE_IMAGE_CACHE_DIR")
+
+
+def decoded_size(image):
+    return image.width * image.height * len(image.getbands())
+
+
+class ImageCache():
+    """
+    LRU of decoded RGB images with TTL (seconds), bounded by `max_bytes` of pixel data, with optional
+    disk tier of encoded images in `disk_dir`, bounded by `max_disk_bytes`.
+    """
+    def __init__(
+        self,
+        max_bytes=256 * 1024 * 1024,
+        ttl=900,
+        disk_dir=DEFAULT_IMAGE_CACHE_DIR,
+        max_disk_bytes=1024 * 1024 * 1024,
+        timeout=(3.05, 30),
+        pool_size=8,
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.downloads = 0
+        # url -> (image, size, added)
+        self._images = OrderedDict()
+        self._bytes = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self._disk_bytes = None
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def _get_memory(self, url):
+        item = self._images.get(url)
+        if item is None:
+            return None
+        image, size, added = item
+        if self.ttl is not None and time.monotonic() - added > self.ttl:
+            del self._images[url]
+            self._bytes -= size
+            return None
+        self._images.move_to_end(url)
+        return image
+
+    def _set_memory(self, url, image):
+        size = decoded_size(image)
+        if size > self.max_bytes:
+            return
+        previous = self._images.pop(url, None)
+        if previous is not None:
+            self._bytes -= previous[1]
+        self._images[url] = (image, size, time.monotonic())
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, (_, evicted_size, _) = self._images.popitem(last=False)
+            self._bytes -= evicted_size
+
+    def get(self, url):
+        """Returns decoded RGB image for url. Only one download per url runs at a time."""
+        with self._lock:
+            image = self._get_memory(url)
+            if image is not None:
+                self.hits += 1
+                return image
+            self.misses += 1
+            future = self._inflight.get(url)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[url] = future
+        if not owner:
+            return future.result()
+        try:
+            image = self._load(url)
+            with self._lock:
+                self._set_memory(url, image)
+            future.set_result(image)
+            return image
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(url, None)
+
+    def _load(self, url):
+        data = self._read_disk(url)
+        if data is None:
+            log.info(f"Downloading image from url: {url}")
+            response = self.session.get(url, timeout=self.timeout)
+            response.raise_for_status()
+            data = response.content
+            self.downloads += 1
+            self._write_disk(url, data)
+        else:
+            log.info(f"Using cached image: {url}")
+        return Image.open(BytesIO(data)).convert("RGB")
+
+    def _disk_filepath(self, url):
+        return os.path.join(self.disk_dir, hashlib.sha1(url.encode()).hexdigest())
+
+    def _read_disk(self, url):
+        if not self.disk_dir:
+            return None
+        filepath = self._disk_filepath(url)
+        try:
+            with open(filepath, "rb") as f:
+                data = f.read()
+            # Disk tier is evicted by modification time, so reads refresh it
+            os.utime(filepath)
+            return data
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            log.warning(f"Failed to read cached image {filepath}: {e}")
+            return None
+
+    def _write_disk(self, url, data):
+        if not self.disk_dir or len(data) > self.max_disk_bytes:
+            return
+        filepath = self._disk_filepath(url)
+        tmp_filepath = f"{filepath}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_filepath, "wb") as f:
+                f.write(data)
+            os.replace(tmp_filepath, filepath)
+        except OSError as e:
+            log.warning(f"Failed to write cached image {filepath}: {e}")
+            return
+        with self._disk_lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(entry.stat().st_size for entry in self._disk_entries())
+            else:
+                self._disk_bytes += len(data)
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict_disk()
+
+    def _disk_entries(self):
+        return [entry for entry in os.scandir(self.disk_dir) if entry.is_file() and not entry.name.endswith(".tmp")]
+
+    def _evict_disk(self):
+        entries = sorted(((entry.stat(), entry.path) for entry in self._disk_entries()), key=lambda item: item[0].st_mtime)
+        self._disk_bytes = sum(stat.st_size for stat, _ in entries)
+        for stat, path in entries:
+            if self._disk_bytes <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+                self._disk_bytes -= stat.st_size
+            except OSError:
+                pass
+
+    @property
+    def size_bytes(self):
+        return self._bytes
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @property
+    def stats(self):
+        return {
+            "images": len(self._images),
+            "memory_bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "downloads": self.downloads,
+        }
+
+    def clear(self, disk=False):
+        with self._lock:
+            self._images.clear()
+            self._bytes = 0
+        if disk and self.disk_dir:
+            with self._disk_lock:
+                for entry in self._disk_entries():
+                    os.remove(entry.path)
+                self._disk_bytes = 0
+
+    def __len__(self):
+        return len(self._images)
+
+    def __contains__(self, url):
+        with self._lock:
+            return self._get_memory(url) is not None
@@ -0,0 +1,114 @@
+"""
+Model configs from model_templates.yaml, matched by model name.
+"""
+import os
+import re
+import threading
+from typing import Any, Dict, List, Optional
+import yaml
+from cachetools import LRUCache
+from loguru import logger as log
+from pydantic import BaseModel, ConfigDict
+from ai_core import APP_DIR
+
+MODEL_TEMPLATES_FILEPATH = os.path.join(APP_DIR, "model_templates.yaml")
+
+
+class ModelConfig(BaseModel):
+    """Config of a model family. Keys not declared here are kept as extra fields."""
+    model_config = ConfigDict(extra='allow', frozen=True)
+
+    pattern: str
+    prompt_format: str
+    max_context: Optional[int] = None
+    stop: List[str] = []
+    tokenizer: Optional[str] = None
+    # Default generation parameters of the model, applied on top of presets
+    parameters: Dict[str, Any] = {}
+
+    @property
+    def default_parameters(self):
+        parameters = dict(self.parameters)
+        if self.stop:
+            parameters.setdefault('stop', list(self.stop))
+        return parameters
+
+    def to_dict(self):
+        """Config as it is written in model_templates.yaml."""
+        return self.model_dump(exclude={'pattern'}, exclude_unset=True)
+
+
+class ModelRegistry():
+    """
+    Loads model_templates.yaml once (reloaded when the file changes), compiles all patterns
+    into one alternation which keeps file order as priority, and memoizes lookups per model name.
+    """
+    def __init__(self, filepath=MODEL_TEMPLATES_FILEPATH, cache_size=256) -> None:
+        self.filepath = filepath
+        self.configs: List[ModelConfig] = []
+        self._mtime = None
+        self._matcher = None
+        self._group_configs = {}
+        self._lookups = LRUCache(maxsize=cache_size)
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with open(self.filepath, "r", encoding="utf-8") as f:
+            raw_configs = yaml.safe_load(f.read()) or {}
+        self.configs = [ModelConfig(pattern=pattern, **config) for pattern, config in raw_configs.items()]
+        try:
+            self._matcher = re.compile(
+                "|".join(f"(?P<model{i}>{config.pattern})" for i, config in enumerate(self.configs)),
+                re.IGNORECASE,
+            )
+            self._group_configs = {self._matcher.groupindex[f"model{i}"]: config for i, config in enumerate(self.configs)}
+        except re.error as e:
+            # Patterns which can't be combined (e.g. numbered backreferences) are matched one by one
+            log.warning(f"Unable to combine model patterns, matching them one by one: {e}")
+            self._matcher = None
+        self._lookups.clear()
+
+    def _check_reload(self):
+        mtime = os.stat(self.filepath).st_mtime_ns
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    log.debug(f"Loading model configs from {self.filepath}")
+                    self._load()
+                    self._mtime = mtime
+
+    def _match(self, model_name) -> Optional[ModelConfig]:
+        if self._matcher is not None:
+            match = self._matcher.match(model_name)
+            if match is None:
+                return None
+            config = self._group_configs.get(match.lastindex)
+            if config is not None:
+                return config
+            return next(config for i, config in enumerate(self.configs) if match.group(f"model{i}") is not None)
+        for config in self.configs:
+            if re.match(config.pattern, model_name, re.IGNORECASE):
+                return config
+        return None
+
+    def find(self, model_name) -> Optional[ModelConfig]:
+        """Returns first matching config, or None."""
+        self._check_reload()
+        try:
+            return self._lookups[model_name]
+        except KeyError:
+            pass
+        config = self._match(model_name)
+        with self._lock:
+            self._lookups[model_name] = config
+        if config is not None:
+            log.debug(f"Found matching model config: {model_name} (REGEX: {config.pattern})")
+        return config
+
+    def get(self, model_name) -> ModelConfig:
+        config = self.find(model_name)
+        if config is None:
+            raise Exception(f"Unable to find matching config for model: {model_name}")
+        return config
+
+model_registry = ModelRegistry()
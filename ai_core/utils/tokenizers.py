@@ -0,0 +1,270 @@
+"""
+Tokenizer backends used for token accounting (counting, trimming, memory windows).
+
+All backends are callable the same way as `ai_core.utils.count_tokens_nltk`, so they can be used
+as `Message.count_tokens_func` or `Memory.tokenizer`.
+"""
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import List
+
+import requests
+from cachetools import LRUCache
+from loguru import logger as log
+
+
+class Tokenizer():
+    """Base tokenizer backend."""
+    name = "base"
+
+    def tokenize(self, text) -> List:
+        raise NotImplementedError()
+
+    def count(self, text) -> int:
+        return len(self.tokenize(text))
+
+    def count_batch(self, texts) -> List[int]:
+        return [self.count(text) for text in texts]
+
+    def token_spans(self, text) -> List[tuple]:
+        """(start, end) character offsets of every token in text. Not all backends support it."""
+        raise NotImplementedError(f"{self.__class__.__name__} does not provide token offsets")
+
+    def __call__(self, *args):
+        """Accepts multiple arguments similar to `print` function, and counts tokens of resulting text."""
+        return self.count(" ".join([str(arg) for arg in args]))
+
+    def trim_text(self, text, max_tokens, from_start=True):
+        """
+        Trims text to fit into max_tokens. Result is a single slice of the original text, so formatting is kept intact.
+        If `from_start` is True - cuts the beginning, leaving the ending part of the text, otherwise cuts the ending.
+        """
+        return self.trim_texts([text], max_tokens, from_start=from_start)[0]
+
+    def trim_texts(self, texts, max_tokens, from_start=True):
+        """Trims every text to fit into max_tokens, see `trim_text`."""
+        try:
+            spans_batch = self.token_spans_batch(texts)
+        except NotImplementedError:
+            return [self._trim_text_by_search(text, max_tokens, from_start) for text in texts]
+        return [_trim_by_spans(text, spans, max_tokens, from_start) for text, spans in zip(texts, spans_batch)]
+
+    def token_spans_batch(self, texts):
+        return [self.token_spans(text) for text in texts]
+
+    def _trim_text_by_search(self, text, max_tokens, from_start):
+        """Binary search over word boundaries for backends that only count tokens."""
+        if self.count(text) <= max_tokens:
+            return text
+        if max_tokens <= 0:
+            return ""
+        # Candidate cut positions, ordered so that the kept part gets shorter
+        if from_start:
+            cuts = [match.start() for match in _WORD_START.finditer(text)][1:]
+            kept = lambda cut: text[cut:]
+        else:
+            cuts = [match.end() for match in _WORD_END.finditer(text)][::-1][1:]
+            kept = lambda cut: text[:cut]
+        low, high = 0, len(cuts)
+        while low < high:
+            middle = (low + high) // 2
+            if self.count(kept(cuts[middle])) <= max_tokens:
+                high = middle
+            else:
+                low = middle + 1
+        return kept(cuts[low]) if low < len(cuts) else ""
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.name})"
+
+
+class RegexTokenizer(Tokenizer):
+    """
+    Fast estimator, no dependencies. Each punctuation character is a token, words are split into
+    chunks of up to `chars_per_token` characters, roughly how BPE tokenizers split long words.
+    """
+    name = "regex"
+
+    def __init__(self, chars_per_token=6) -> None:
+        self.chars_per_token = chars_per_token
+        self.pattern = re.compile(r"\w{1,%d}|[^\w\s]" % chars_per_token)
+
+    def tokenize(self, text):
+        return self.pattern.findall(text)
+
+    def token_spans(self, text):
+        return [match.span() for match in self.pattern.finditer(text)]
+
+
+class NLTKTokenizer(Tokenizer):
+    """NLTK word tokenization, same as `ai_core.utils.count_tokens_nltk`."""
+    name = "nltk"
+
+    def __init__(self, language="english") -> None:
+        self.language = language
+
+    def _sentence_tokenizer(self):
+        # Same punkt model as `sent_tokenize`, which `word_tokenize` uses before word splitting
+        import nltk.tokenize
+        if hasattr(nltk.tokenize, "_get_punkt_tokenizer"):
+            return nltk.tokenize._get_punkt_tokenizer(self.language)
+        import nltk.data
+        return nltk.data.load(f"tokenizers/punkt/{self.language}.pickle")
+
+    def tokenize(self, text):
+        from nltk.tokenize import word_tokenize
+        return word_tokenize(text, language=self.language)
+
+    def token_spans(self, text):
+        """Spans of `word_tokenize` tokens: sentences are split with punkt, then each sentence is word tokenized."""
+        from nltk.tokenize import NLTKWordTokenizer
+        word_tokenizer = NLTKWordTokenizer()
+        spans = []
+        for sentence_start, sentence_end in self._sentence_tokenizer().span_tokenize(text):
+            spans.extend(
+                (sentence_start + start, sentence_start + end)
+                for start, end in word_tokenizer.span_tokenize(text[sentence_start:sentence_end])
+            )
+        return spans
+
+
+class HFTokenizer(Tokenizer):
+    """HuggingFace `transformers` fast tokenizer. Use `get_tokenizer("hf:<model_id>")` to load it once per model."""
+
+    def __init__(self, model_id) -> None:
+        from transformers import AutoTokenizer
+        log.info(f"Loading tokenizer: {model_id}")
+        self.name = f"hf:{model_id}"
+        self.model_id = model_id
+        self.tokenizer = AutoTokenizer.from_pretrained(model_id, use_fast=True)
+
+    def tokenize(self, text):
+        return self.tokenizer(text, add_special_tokens=False)['input_ids']
+
+    def count_batch(self, texts):
+        if not texts:
+            return []
+        return [len(ids) for ids in self.tokenizer(list(texts), add_special_tokens=False)['input_ids']]
+
+    def token_spans(self, text):
+        return self.token_spans_batch([text])[0]
+
+    def token_spans_batch(self, texts):
+        if not texts:
+            return []
+        encoded = self.tokenizer(list(texts), add_special_tokens=False, return_offsets_mapping=True)
+        return [[tuple(span) for span in spans] for spans in encoded['offset_mapping']]
+
+
+class OpenedAITokenizer(Tokenizer):
+    """
+    Counts tokens with the model currently loaded on OpenedAI server (text-generation-webui),
+    using `/v1/internal/token-count`. Results are cached per text, batches are deduplicated and sent concurrently.
+    """
+
+    def __init__(self, host, cache_size=8192, max_workers=8, timeout=30) -> None:
+        self.name = f"openedai:{host}"
+        self.host = host
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self._tokens_url = f'{host}/v1/internal/token-count'
+        self._encode_url = f'{host}/v1/internal/encode'
+        self._session = requests.Session()
+        self._cache = LRUCache(maxsize=cache_size)
+        self._lock = threading.Lock()
+
+    def _request_count(self, text):
+        response = self._session.post(self._tokens_url, json={"text": text}, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()['length']
+
+    def tokenize(self, text):
+        response = self._session.post(self._encode_url, json={"text": text}, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()['tokens']
+
+    def count(self, text):
+        return self.count_batch([text])[0]
+
+    def count_batch(self, texts):
+        with self._lock:
+            counts = {text: self._cache.get(text) for text in texts}
+        missing = [text for text, count in counts.items() if count is None]
+        if len(missing) == 1:
+            counts[missing[0]] = self._request_count(missing[0])
+        elif missing:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(missing))) as executor:
+                counts.update(zip(missing, executor.map(self._request_count, missing)))
+        with self._lock:
+            for text in missing:
+                self._cache[text] = counts[text]
+        return [counts[text] for text in texts]
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+_WORD_START = re.compile(r"(?<!\S)\S")
+_WORD_END = re.compile(r"\S(?!\S)")
+
+def _trim_by_spans(text, spans, max_tokens, from_start):
+    if len(spans) <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+    if from_start:
+        return text[spans[len(spans) - max_tokens][0]:]
+    return text[:spans[max_tokens - 1][1]]
+
+
+@lru_cache(maxsize=None)
+def _get_tokenizer(spec):
+    backend, _, argument = spec.partition(":")
+    if backend == "regex":
+        return RegexTokenizer()
+    if backend == "nltk":
+        return NLTKTokenizer()
+    if backend == "hf":
+        return HFTokenizer(argument)
+    if backend == "openedai":
+        return OpenedAITokenizer(argument)
+    raise ValueError(f"Unknown tokenizer: {spec}")
+
+def get_tokenizer(spec="nltk"):
+    """
+    Returns tokenizer backend, loaded once per spec:
+        "regex" - fast estimator
+        "nltk" - NLTK word tokenizer
+        "hf:<model_id>" - HuggingFace fast tokenizer
+        "openedai:<host>" - token counting endpoint of OpenedAI server
+    Tokenizer instances and plain callables are returned as is.
+    """
+    if spec is None:
+        spec = "nltk"
+    if not isinstance(spec, str):
+        return spec
+    return _get_tokenizer(spec)
+
+def tokenizer_id(count_tokens_func) -> str:
+    """
+    Identifier of a token counting function or tokenizer, stored with precomputed token counts
+    to tell whether they can be reused.
+    """
+    tokenizer = getattr(count_tokens_func, "__self__", count_tokens_func)
+    if isinstance(tokenizer, Tokenizer):
+        return tokenizer.name
+    return f"{getattr(count_tokens_func, '__module__', None)}.{getattr(count_tokens_func, '__qualname__', type(count_tokens_func).__qualname__)}"
+
+def get_tokenizer_for_model(model_name, host=None, default="nltk"):
+    """
+    Selects tokenizer by `tokenizer` key of model config in model_templates.yaml.
+    `server` means counting with OpenedAI server at `host`.
+    """
+    from ai_core.utils.models import model_registry
+    spec = model_registry.get(model_name).tokenizer or default
+    if spec == "server":
+        spec = f"openedai:{host}" if host else default
+    return get_tokenizer(spec)
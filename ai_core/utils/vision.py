@@ -1,10 +1,15 @@
 from PIL import Image, ImageOps
 import requests
 import base64
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from io import BytesIO
 from urllib.parse import urljoin
-from utils import extract_image_urls
-from datetime import datetime,timedelta
+from ai_core.utils import find_image_urls, replace_spans
+from ai_core.utils.image_cache import ImageCache
+from datetime import timedelta
 
 from loguru import logger as log
 import urllib.parse
@@ -31,12 +36,57 @@ wd14_models = [
     'mld-tresnetd.6-30000',
 ]
 
+class PreparedImage():
+    """
+    Image decoded once, with memoized resized variants and base64 encodings by (size, format, quality),
+    so every interrogator reuses the same payload.
+    """
+    def __init__(self, image, source=None) -> None:
+        self.image = image if image.mode == "RGB" else image.convert("RGB")
+        self.source = source
+        self._variants = {None: self.image}
+        self._encoded = {}
+        self._lock = threading.Lock()
+
+    def resized(self, size=None):
+        """Returns image fitted into `size` (width, height) keeping aspect ratio, original if size is None."""
+        size = tuple(size) if size is not None else None
+        with self._lock:
+            variant = self._variants.get(size)
+            if variant is None:
+                variant = ImageOps.contain(self.image, size)
+                self._variants[size] = variant
+            return variant
+
+    def to_base64(self, size=None, format="JPEG", quality=None):
+        key = (tuple(size) if size is not None else None, format, quality)
+        encoded = self._encoded.get(key)
+        if encoded is None:
+            image = self.resized(size)
+            buffered = BytesIO()
+            if quality is None:
+                image.save(buffered, format=format)
+            else:
+                image.save(buffered, format=format, quality=quality)
+            encoded = base64.b64encode(buffered.getvalue()).decode()
+            with self._lock:
+                encoded = self._encoded.setdefault(key, encoded)
+        return encoded
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.source or self.image.size})"
+
+
 class Vision():
     VISION_INITIALIZED = False
     VISION_MODEL = None
     VISION_PROCESSOR = None
-    IMG_CACHE = {}
     IMG_CACHE_EXPIRE_DELTA = timedelta(minutes=15)
+    # Shared by all instances unless IMAGE_CACHE is given in config
+    IMG_CACHE = ImageCache(ttl=IMG_CACHE_EXPIRE_DELTA.total_seconds())
+    # (backend, host) -> semaphore, shared by all instances so limits hold per server
+    BACKEND_SEMAPHORES = {}
+    BACKEND_SEMAPHORES_LOCK = threading.Lock()
     def __init__(self, config):
         self.config = {
             'AUTOMATIC1111_HOST': None,
@@ -44,9 +94,15 @@ class Vision():
             'OLLAMA_VISION_MODEL': None,
             'OLLAMA_DEFAULT_MODEL': None,
             'BASE_SITES': {},
-            'BLIP_MODEL_ID': "Salesforce/blip-image-captioning-base"
+            'BLIP_MODEL_ID': "Salesforce/blip-image-captioning-base",
+            'IMAGE_CACHE': None,
+            # Max concurrent requests per backend server
+            'BACKEND_CONCURRENCY': {'ollama': 2, 'automatic1111': 4, 'blip': 1},
+            # Overall time limit in seconds for caption_image, analyze_image and see, None for no limit
+            'VISION_TIMEOUT': 300,
         }
         self.config.update(config)
+        self.image_cache = self.config['IMAGE_CACHE'] if self.config['IMAGE_CACHE'] is not None else Vision.IMG_CACHE
 
 
     def init_blip(self, force=False):
@@ -62,30 +118,71 @@ class Vision():
         return Vision.VISION_INITIALIZED
 
 
-    def download_image_cached(self, url):
-        pop_items = []
-        for key, value in Vision.IMG_CACHE.items():
-            if datetime.now() - value['added'] > Vision.IMG_CACHE_EXPIRE_DELTA:
-                pop_items.append(key)
+    @contextmanager
+    def backend_slot(self, backend, host=None):
+        """Limits concurrent requests to a backend, see BACKEND_CONCURRENCY config."""
+        key = (backend, host)
+        semaphore = Vision.BACKEND_SEMAPHORES.get(key)
+        if semaphore is None:
+            with Vision.BACKEND_SEMAPHORES_LOCK:
+                semaphore = Vision.BACKEND_SEMAPHORES.get(key)
+                if semaphore is None:
+                    semaphore = threading.BoundedSemaphore(self.config['BACKEND_CONCURRENCY'].get(backend, 1))
+                    Vision.BACKEND_SEMAPHORES[key] = semaphore
+        with semaphore:
+            yield
+
+    def get_deadline(self, timeout=None):
+        timeout = self.config['VISION_TIMEOUT'] if timeout is None else timeout
+        return None if timeout is None else time.monotonic() + timeout
+
+    @staticmethod
+    def remaining(deadline):
+        return None if deadline is None else max(0, deadline - time.monotonic())
+
+    def fan_out(self, calls, deadline=None):
+        """
+        Runs callables concurrently and returns their results in order.
+        Calls that failed or did not finish before deadline (time.monotonic() value) result in None.
+        """
+        if not calls:
+            return []
+        executor = ThreadPoolExecutor(max_workers=len(calls), thread_name_prefix="vision")
+        futures = [executor.submit(call) for call in calls]
+        _, not_done = wait(futures, timeout=self.remaining(deadline))
+        executor.shutdown(wait=False, cancel_futures=True)
+        results = []
+        for future in futures:
+            if future in not_done:
+                log.warning("Vision call did not finish before deadline.")
+                results.append(None)
+            elif future.exception() is not None:
+                log.opt(exception=future.exception()).error(f"Vision call failed: {future.exception()}")
+                results.append(None)
+            else:
+                results.append(future.result())
+        return results
 
-        for key in pop_items:
-            Vision.IMG_CACHE_EXPIRE_DELTA.pop(key)
 
+    def download_image_cached(self, url):
+        return self.image_cache.get(url)
 
-        if url not in Vision.IMG_CACHE:
-            log.info(f"Downloading image from url: {url}")
-            Vision.IMG_CACHE[url] = {
-                "added": datetime.now(),
-                "data": Image.open(requests.get(url, stream=True).raw).convert("RGB")
-            }
-        else:
-            log.info(f"Using cached image: {url}")
-        
-        return Vision.IMG_CACHE[url]['data']
+
+    def prepare_image(self, image):
+        """Takes image as URL, PIL.Image.Image or PreparedImage instance. Returns PreparedImage instance."""
+        if isinstance(image, PreparedImage):
+            return image
+        source = image if isinstance(image, str) else None
+        image = self.get_image(image)
+        if image is None:
+            return None
+        return PreparedImage(image, source=source)
 
 
     def get_image(self, image):
-        """Takes image as URL or PIL.Image.Image instance. Returns PIL.Image.Image instance."""
+        """Takes image as URL, PIL.Image.Image or PreparedImage instance. Returns PIL.Image.Image instance."""
+        if isinstance(image, PreparedImage):
+            return image.image
         try:
             if not isinstance(image, Image.Image):
                 log.info(f"Get image from URL: {image}")
@@ -105,21 +202,20 @@ class Vision():
             log.exception(e)
 
 
-    def image_to_base64(self, image, format="JPEG"):
-        image = self.get_image(image)
+    def image_to_base64(self, image, format="JPEG", size=None):
+        image = self.prepare_image(image)
         if image:
-            buffered = BytesIO()
-            image.save(buffered, format=format)
-            return base64.b64encode(buffered.getvalue()).decode()
+            return image.to_base64(size=size, format=format)
 
 
-    def interrogate_with_wd14_remote(self, image, model="wd14-swinv2-v2-git", threshold=0.8):
+    def interrogate_with_wd14_remote(self, image, model="wd14-swinv2-v2-git", threshold=0.8, deadline=None):
         """Uses Automatic1111 API and WD14 tagger extension to provide captioning
 
         Args:
             image (_type_): Image to process, either URL or PIL.Image.Image instance.
             model (str, optional): Model(s) to use, string or list of string. Defaults to "wd14-swinv2-v2-git".
             threshold (float, optional): Threshold for tag confidence to include. Defaults to 0.8.
+            deadline (float, optional): time.monotonic() value after which unfinished models are skipped.
 
         Returns:
             _type_: A list of strings, tags
@@ -127,28 +223,36 @@ class Vision():
         models = [model] if isinstance(model, str) else model
         tags = []
         ratings = []
-        image = self.get_image(image)
+        image = self.prepare_image(image)
         if not image:
-            return tags
+            return tags, ratings
+
+        img_str = image.to_base64()
+        host = self.config['AUTOMATIC1111_HOST']
 
-        for model in models:
-            try:
-                img_str = self.image_to_base64(image)
+        def interrogate(model):
+            """Returns (tags, ratings) of a single model, parsed here so a failing model is skipped by fan_out."""
+            with self.backend_slot("automatic1111", host):
                 response = requests.post(
-                    urljoin(self.config['AUTOMATIC1111_HOST'], "/tagger/v1/interrogate"),
+                    urljoin(host, "/tagger/v1/interrogate"),
                     json={"image": img_str, "model": model, "threshold": 0.35},
                     timeout=120,
                 )
-                tags = []
-                data = response.json()
-                for tag, value in data["caption"]['tag'].items():
-                    if value >= threshold and tag not in tags:
-                        tags.append(tag)
-                for tag, value in data["caption"]['rating'].items():
-                    if value >= threshold and tag not in ratings:
-                        ratings.append(tag)
-            except Exception as e:
-                log.exception(e)
+            response.raise_for_status()
+            data = response.json()["caption"]
+            return (
+                [tag for tag, value in data['tag'].items() if value >= threshold],
+                [tag for tag, value in data['rating'].items() if value >= threshold],
+            )
+
+        # Models are queried concurrently, tags are merged in models order
+        results = self.fan_out([lambda model=model: interrogate(model) for model in models], deadline=deadline)
+        for result in results:
+            if result is None:
+                continue
+            model_tags, model_ratings = result
+            tags.extend(tag for tag in model_tags if tag not in tags)
+            ratings.extend(tag for tag in model_ratings if tag not in ratings)
         return tags, ratings
 
 
@@ -192,12 +296,12 @@ class Vision():
         if model is None:
             model = self.config['OLLAMA_VISION_MODEL']
         log.debug(f"Interrogating with Ollama: {image}, {model}...")
-        image = self.get_image(image)
+        image = self.prepare_image(image)
         if not image:
             return None
-        image = ImageOps.contain(image, (768, 768))
+        response = None
         try:
-            img_str = self.image_to_base64(image)
+            img_str = image.to_base64(size=(768, 768))
             payload = {
                 "model": model,
                 "prompt": prompt,
@@ -209,11 +313,12 @@ class Vision():
             }
             if system:
                 payload[system] = system
-            response = requests.post(
-                urljoin(self.config['OLLAMA_HOST'], "/api/generate"),
-                json=payload,
-                timeout=120,
-            )
+            with self.backend_slot("ollama", self.config['OLLAMA_HOST']):
+                response = requests.post(
+                    urljoin(self.config['OLLAMA_HOST'], "/api/generate"),
+                    json=payload,
+                    timeout=120,
+                )
             if response:
                 data = response.json()["response"]
             else:
@@ -228,20 +333,20 @@ class Vision():
 
     def interrogate_with_automatic1111_remote(self, image, model="clip"):
         log.debug(f"Interrogating with Automatic1111: {image}, {model}...")
-        image = self.get_image(image)
+        image = self.prepare_image(image)
         if not image:
             return None
-        image = ImageOps.contain(image, (768, 768))
         try:
-            img_str = self.image_to_base64(image)
-            response = requests.post(
-                urljoin(self.config['AUTOMATIC1111_HOST'], "/sdapi/v1/interrogate"),
-                json={
-                    "image": img_str,
-                    "model": model,
-                },
-                timeout=120,
-            )
+            img_str = image.to_base64(size=(768, 768))
+            with self.backend_slot("automatic1111", self.config['AUTOMATIC1111_HOST']):
+                response = requests.post(
+                    urljoin(self.config['AUTOMATIC1111_HOST'], "/sdapi/v1/interrogate"),
+                    json={
+                        "image": img_str,
+                        "model": model,
+                    },
+                    timeout=120,
+                )
             data = response.json()["caption"]
             return data
         except Exception as e:
@@ -251,14 +356,15 @@ class Vision():
     def interrogate_with_blip_local(self, image):
         self.init_blip()
         image = self.get_image(image)
-        inputs = Vision.VISION_PROCESSOR(image, return_tensors="pt")
-        out = Vision.VISION_MODEL.generate(**inputs)
-        caption = Vision.VISION_PROCESSOR.decode(out[0], skip_special_tokens=True)
+        with self.backend_slot("blip"):
+            inputs = Vision.VISION_PROCESSOR(image, return_tensors="pt")
+            out = Vision.VISION_MODEL.generate(**inputs)
+            caption = Vision.VISION_PROCESSOR.decode(out[0], skip_special_tokens=True)
 
         return caption
 
 
-    def analyze_image(self, img, model=None, questions=[], questions_person=[], system_prompt=""):
+    def analyze_image(self, img, model=None, questions=[], questions_person=[], system_prompt="", timeout=None):
         """_summary_
 
         Args:
@@ -266,6 +372,7 @@ class Vision():
             model (_type_, optional): 
             questions (list, optional): A list of questions to ask the model about the image. Each one is a separate request to the vLLM, all resulting strings are combined into a single text.
             questions_person  (list, optional): A list of questions which is used in case a model detects there's a person on the image.
+            timeout (float, optional): Overall time limit in seconds, questions not answered by then are skipped. Defaults to VISION_TIMEOUT config.
             # TODO Let's make it so it can also run an extra query to another LLM to combine these outputs into a single text output. This can help reduce the amount of text in the resulting answer and make it more coherent. But it's very low priority.
 
         Returns:
@@ -274,7 +381,8 @@ class Vision():
         if model is None:
             model = self.config['OLLAMA_VISION_MODEL']
 
-        response = ""
+        deadline = self.get_deadline(timeout)
+        img = self.prepare_image(img)
         is_person = bool(int(self.interrogate_with_ollama_remote(
                 img,
                 model=model,
@@ -285,43 +393,51 @@ class Vision():
         if is_person:
             questions = questions_person
 
-        for q in questions:
-            response += self.interrogate_with_ollama_remote(
-                img,
-                model=model,
-                prompt=q,
-                system=system_prompt
-            ) + "\n\n"
-
-        return response
+        # Questions are independent, so they are asked concurrently
+        answers = self.fan_out([
+            lambda q=q: self.interrogate_with_ollama_remote(img, model=model, prompt=q, system=system_prompt)
+            for q in questions
+        ], deadline=deadline)
+        return "".join(answer + "\n\n" for answer in answers if answer is not None)
 
     def caption_image(
         self,
         image,
         see_models=["wd14-convnextv2-v2", "wd14-vit-v2", "wd14-convnext"],
         tags_joiner=" #",
+        timeout=None,
     ):
+        deadline = self.get_deadline(timeout)
         log.info(f"Downloading Image: {image}...")
-        image = self.get_image(
-            image
-        )  # Image.open(requests.get(image, stream=True).raw).convert('RGB')
+        # Decoded and encoded once, shared by all interrogators below
+        image = self.prepare_image(image)
         log.info("Image downloaded. Processing.")
 
-        if self.config["OLLAMA_HOST"] is not None:
-            log.info("Using automatic1111 for caption.")
-            caption = self.analyze_image(image).replace("\n", " ")
-        elif self.config["AUTOMATIC1111_HOST"] is not None:
-            log.info("Using automatic1111 for caption.")
-            caption = self.interrogate_with_automatic1111_remote(image)
-        else:
-            caption = self.interrogate_with_blip_local(image)
-        if caption is None or "<error>" in caption:
-            log.warning("Caption was generated with <error>")
-        caption = caption.replace("<error>", "") if caption else ""
-        if not caption.split():
-            log.info("Using local blip for caption.")
-            caption = self.interrogate_with_blip_local(image)
-        tags = self.interrogate_with_wd14_remote(image, model=see_models, threshold=0.17)
+        def get_caption():
+            if self.config["OLLAMA_HOST"] is not None:
+                log.info("Using ollama for caption.")
+                caption = self.analyze_image(image, timeout=self.remaining(deadline))
+                caption = caption.replace("\n", " ") if caption else caption
+            elif self.config["AUTOMATIC1111_HOST"] is not None:
+                log.info("Using automatic1111 for caption.")
+                caption = self.interrogate_with_automatic1111_remote(image)
+            else:
+                caption = self.interrogate_with_blip_local(image)
+            if caption is None or "<error>" in caption:
+                log.warning("Caption was generated with <error>")
+            caption = caption.replace("<error>", "") if caption else ""
+            if not caption.split():
+                log.info("Using local blip for caption.")
+                caption = self.interrogate_with_blip_local(image)
+            return caption
+
+        # Caption and tags come from different backends, so they run concurrently
+        caption, tagging = self.fan_out([
+            get_caption,
+            lambda: self.interrogate_with_wd14_remote(image, model=see_models, threshold=0.17, deadline=deadline),
+        ], deadline=deadline)
+        caption = caption or ""
+        tags, ratings = tagging or ([], [])
         text = caption
         for tag in tags:
             text += " " + tags_joiner + tag
@@ -336,40 +452,43 @@ class Vision():
         see_models=["wd14-convnextv2-v2", "wd14-vit-v2", "wd14-convnext"],
         tags_joiner=" #",
         base_site_adapter_id=None,
+        timeout=None,
     ):
-        (
-            image_urls,
-            raw_image_urls,
-            non_image_urls,
-            raw_non_image_urls,
-        ) = extract_image_urls(
+        deadline = self.get_deadline(timeout)
+        image_matches, non_image_matches = find_image_urls(
             text,
             base_site=self.config['BASE_SITES'].get(
                 base_site_adapter_id,
                 f"NO_BASE_SITE_FOR_{base_site_adapter_id}_ADAPTER",
             ),
         )
-        for i, image_url in enumerate(image_urls):
-            try:
-                caption, tags, caption_text = self.caption_image(image_url)
-                if caption:
-                    text = text.replace(
-                        raw_image_urls[i],
-                        f"<vision_system_note>This is what {bot_name} can see - {caption_text}</vision_system_note>",
-                    )
-                else:
-                    text = text.replace(
-                        raw_image_urls[i],
-                        f"<vision_system_note>{user_name} sent you an image, but {bot_name} can't recognize what's on it. You must say that you can't see the image, as user to use a different URL.</vision_system_note>",
-                    )
-            except Exception as e:
-                log.error(f"Failed processing image url: {image_url} ({e})")
-
-        for i, raw_url in enumerate(raw_non_image_urls):
-            text = text.replace(
-                raw_url,
-                f"<vision_system_note>{user_name} sent you an URL, but {bot_name} can't open this url: {raw_url}</vision_system_note>",
-            )
+        # Notes per absolute url, so repeated links are captioned once, images are captioned concurrently
+        urls = list(dict.fromkeys(match.url for match in image_matches))
+        captions = self.fan_out([
+            lambda url=url: self.caption_image(url, see_models=see_models, tags_joiner=tags_joiner, timeout=self.remaining(deadline))
+            for url in urls
+        ], deadline=deadline)
+        notes = {}
+        for url, result in zip(urls, captions):
+            if result is None:
+                log.error(f"Failed processing image url: {url}")
+                notes[url] = None
+                continue
+            caption, tags, caption_text = result
+            if caption:
+                notes[url] = f"<vision_system_note>This is what {bot_name} can see - {caption_text}</vision_system_note>"
+            else:
+                notes[url] = f"<vision_system_note>{user_name} sent you an image, but {bot_name} can't recognize what's on it. You must say that you can't see the image, as user to use a different URL.</vision_system_note>"
+
+        replacements = [
+            (match.start, match.end, notes[match.url])
+            for match in image_matches if notes[match.url] is not None
+        ]
+        replacements.extend(
+            (match.start, match.end, f"<vision_system_note>{user_name} sent you an URL, but {bot_name} can't open this url: {match.raw}</vision_system_note>")
+            for match in non_image_matches
+        )
+        text = replace_spans(text, replacements)
 
         return text
 
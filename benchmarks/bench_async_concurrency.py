@@ -0,0 +1,71 @@
+"""
+Concurrency scaling of AsyncOpenedAI against a local stub server, where every completion takes `DELAY` seconds.
+With working connection pooling total time stays close to DELAY until `max_concurrency` is reached.
+
+Usage: PYTHONPATH=. python benchmarks/bench_async_concurrency.py
+"""
+import asyncio
+import time
+from aiohttp import web
+from loguru import logger as log
+
+from ai_core.integrations.openedai_async import AsyncOpenedAI, AsyncOpenedAIChat
+from ai_core.memory import UserMessage
+
+DELAY = 0.2
+OPENAPI = {"components": {"schemas": {
+    "CompletionRequest": {"properties": {"prompt": {}, "stream": {}, "max_tokens": {}}},
+    "ChatCompletionRequest": {"properties": {"messages": {}, "max_tokens": {}}},
+}}}
+
+
+async def openapi(request):
+    return web.json_response(OPENAPI)
+
+async def completions(request):
+    payload = await request.json()
+    await asyncio.sleep(DELAY)
+    return web.json_response({"choices": [{"text": payload["prompt"][::-1], "finish_reason": "stop"}]})
+
+async def chat_completions(request):
+    payload = await request.json()
+    await asyncio.sleep(DELAY)
+    content = payload["messages"][-1]["content"][::-1]
+    return web.json_response({"choices": [{"message": {"role": "assistant", "content": content}, "finish_reason": "stop"}]})
+
+async def start_stub_server(port=8765):
+    app = web.Application()
+    app.router.add_get("/openapi.json", openapi)
+    app.router.add_post("/v1/completions", completions)
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", port)
+    await site.start()
+    return runner, f"http://127.0.0.1:{port}"
+
+async def main():
+    log.remove()
+    runner, host = await start_stub_server()
+    try:
+        async with AsyncOpenedAI(host=host, max_concurrency=256) as completion:
+            for count in (1, 10, 100, 500):
+                start = time.perf_counter()
+                results = await asyncio.gather(*[completion(f"prompt {i}", {"max_tokens": 10, "unknown": 1}) for i in range(count)])
+                elapsed = time.perf_counter() - start
+                assert results == [f"prompt {i}"[::-1] for i in range(count)]
+                print(f"completions {count:4} concurrent: {elapsed:6.2f} s ({count / elapsed:7.1f} req/s)")
+
+        async with AsyncOpenedAIChat(host=host, max_concurrency=256) as chat:
+            count = 100
+            start = time.perf_counter()
+            results = await asyncio.gather(*[chat([UserMessage(text=f"message {i}")]) for i in range(count)])
+            elapsed = time.perf_counter() - start
+            assert [result.text for result in results] == [f"message {i}"[::-1] for i in range(count)]
+            print(f"chat        {count:4} concurrent: {elapsed:6.2f} s ({count / elapsed:7.1f} req/s)")
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,48 @@
+"""
+Benchmark: Memory_TokenWindow vs Memory_SlidingWindow on long histories.
+
+Usage: PYTHONPATH=. python benchmarks/bench_memory_window.py
+"""
+import time
+from ai_core.memory import Memory_SlidingWindow, Memory_TokenWindow, UserMessage, AIMessage
+
+
+def count_tokens_split(*args):
+    return len(" ".join(str(arg) for arg in args).split())
+
+def make_messages(count):
+    messages = []
+    for i in range(count):
+        cls = AIMessage if i % 2 else UserMessage
+        messages.append(cls(text=f"Message number {i}. " * (i % 7 + 1)))
+    return messages
+
+def run(memory_class, messages, turns, **kwargs):
+    memory = memory_class(tokenizer=count_tokens_split, **kwargs)
+    start = time.perf_counter()
+    for message in messages[:-turns]:
+        memory.add_message(message)
+    fill_time = time.perf_counter() - start
+
+    # Every chat turn adds a message and reads the window
+    start = time.perf_counter()
+    for message in messages[-turns:]:
+        memory.add_message(message)
+        window = memory.messages
+    turn_time = (time.perf_counter() - start) / turns
+    return fill_time, turn_time, window
+
+
+if __name__ == "__main__":
+    turns = 200
+    for count in (10_000, 100_000):
+        messages = make_messages(count)
+        for message in messages:
+            message.count_tokens(count_tokens_split)
+        for kwargs in (dict(token_limit=8000), dict(token_limit=8000, keep_max=count // 2)):
+            results = {}
+            for memory_class in (Memory_SlidingWindow, Memory_TokenWindow):
+                fill_time, turn_time, window = run(memory_class, messages, turns, **kwargs)
+                results[memory_class.__name__] = window
+                print(f"{memory_class.__name__:22} {count:>7} messages {str(kwargs):40} fill {fill_time * 1000:9.1f} ms, per turn {turn_time * 1000:8.3f} ms")
+            assert results['Memory_SlidingWindow'] == results['Memory_TokenWindow']
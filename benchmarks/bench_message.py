@@ -0,0 +1,48 @@
+"""
+Memory footprint and construction time of Message versus the previous pydantic based model.
+
+Usage: PYTHONPATH=. python benchmarks/bench_message.py
+"""
+import time
+import tracemalloc
+from typing import Callable
+from pydantic import BaseModel
+
+from ai_core.memory import UserMessage, messages_from_dicts
+from ai_core.utils import count_tokens_nltk
+
+
+class LegacyMessage(BaseModel):
+    text: str
+    count_tokens_func: Callable = count_tokens_nltk
+    name: str = ""
+
+class LegacyUserMessage(LegacyMessage):
+    def __init__(self, **data):
+        super().__init__(**data)
+        if not self.name:
+            self.name = "User"
+
+
+def measure(create, count):
+    texts = [f"Message number {i}" for i in range(count)]
+    tracemalloc.start()
+    start = time.perf_counter()
+    messages = create(texts)
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(messages) == count
+    return elapsed, size
+
+
+if __name__ == "__main__":
+    count = 100_000
+    variants = {
+        "LegacyUserMessage": lambda texts: [LegacyUserMessage(text=text) for text in texts],
+        "UserMessage": lambda texts: [UserMessage(text) for text in texts],
+        "messages_from_dicts": lambda texts: messages_from_dicts([{"role": "user", "text": text} for text in texts]),
+    }
+    for name, create in variants.items():
+        elapsed, size = measure(create, count)
+        print(f"{name:20} {count} messages: {elapsed * 1000:8.1f} ms, {size / count:7.1f} bytes/message")
@@ -0,0 +1,50 @@
+"""
+Recall index latency: exact VectorIndex vs approximate IVFVectorIndex at 10k/100k/1M entries.
+
+Usage: PYTHONPATH=. python benchmarks/bench_recall.py [dim]
+"""
+import sys
+import time
+import numpy as np
+from loguru import logger as log
+
+from ai_core.memory.recall import VectorIndex, IVFVectorIndex, HashingEmbedder
+
+
+def random_vectors(rng, count, dim):
+    vectors = rng.standard_normal((count, dim), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+def timed(function, repeat=20):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+    return (time.perf_counter() - start) / repeat, result
+
+
+if __name__ == "__main__":
+    log.remove()
+    dim = int(sys.argv[1]) if len(sys.argv) > 1 else 128
+    rng = np.random.default_rng(0)
+
+    embedder = HashingEmbedder(dim=dim)
+    texts = [f"Message number {i} about topic {i % 97} and detail {i % 13}" for i in range(10_000)]
+    elapsed, _ = timed(lambda: embedder.embed(texts), repeat=1)
+    print(f"HashingEmbedder: {len(texts) / elapsed:,.0f} texts/s")
+
+    for count in (10_000, 100_000, 1_000_000):
+        vectors = random_vectors(rng, count, dim)
+        # Queries close to known vectors, to measure recall of the approximate index
+        targets = rng.choice(count, size=32, replace=False)
+        queries = vectors[targets] + random_vectors(rng, 32, dim) * 0.3
+        for index in (VectorIndex(dim), IVFVectorIndex(dim, n_lists=max(16, int(np.sqrt(count))), n_probe=8, train_size=min(count, 20_000))):
+            start = time.perf_counter()
+            for chunk in range(0, count, 100_000):
+                index.add(vectors[chunk:chunk + 100_000], range(chunk, min(count, chunk + 100_000)))
+            build = time.perf_counter() - start
+            single, _ = timed(lambda: index.search(queries[:1], k=5))
+            batch, results = timed(lambda: index.search(queries, k=5), repeat=5)
+            recall = np.mean([result[0][1] == target for result, target in zip(results, targets)])
+            print(f"{index.__class__.__name__:15} {count:>9,} entries: build {build:7.2f} s, 1 query {single * 1000:8.2f} ms, "
+                  f"32 queries {batch * 1000:8.2f} ms, recall@1 {recall:.2f}")
@@ -0,0 +1,55 @@
+"""
+Micro-benchmark: prompt building with compiled prompt formats vs. the old per-call load/compile path.
+
+Usage: PYTHONPATH=. python benchmarks/bench_templating.py [messages_count]
+"""
+import os
+import sys
+import timeit
+import yaml
+from jinja2 import Environment, BaseLoader
+from loguru import logger as log
+
+from ai_core.memory import SystemMessage, UserMessage, AIMessage
+from ai_core.templating import messages_to_prompt, CHAT_TEMPLATES_DIR
+
+
+def legacy_render_template_string(template_string, context):
+    env = Environment(autoescape=False, loader=BaseLoader, trim_blocks=True, lstrip_blocks=True, keep_trailing_newline=True)
+    return env.from_string(template_string).render(**context)
+
+def legacy_messages_to_prompt(messages, template_name='chatml', next_message_name=None):
+    with open(os.path.join(CHAT_TEMPLATES_DIR, f"{template_name}.yaml"), "r", encoding="utf-8") as f:
+        config = yaml.safe_load(f.read())
+    text = config['prefix']
+    for message in messages:
+        if isinstance(message, AIMessage):
+            t = config['AIMessage']
+        elif isinstance(message, UserMessage):
+            t = config['UserMessage']
+        else:
+            t = config['SystemMessage']
+        text += legacy_render_template_string(t, context={"message": message})
+    text += legacy_render_template_string(config['suffix'], context={"next_message_name": next_message_name})
+    return text
+
+def make_messages(count):
+    messages = [SystemMessage(text="You are a roleplay assistant. " * 20)]
+    for i in range(count):
+        if i % 2:
+            messages.append(AIMessage(text=f"Reply number {i}. " * 10, name="Bot"))
+        else:
+            messages.append(UserMessage(text=f"Message number {i}. " * 10, name="User"))
+    return messages
+
+
+if __name__ == "__main__":
+    log.remove()
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    messages = make_messages(count)
+    for template_name in ("chatml", "llama3-instruct"):
+        assert legacy_messages_to_prompt(messages, template_name, "Bot") == messages_to_prompt(messages, template_name=template_name, next_message_name="Bot")
+        number = 5
+        legacy = timeit.timeit(lambda: legacy_messages_to_prompt(messages, template_name, "Bot"), number=number) / number
+        compiled = timeit.timeit(lambda: messages_to_prompt(messages, template_name=template_name, next_message_name="Bot"), number=number) / number
+        print(f"{template_name:16} {count} messages: legacy {legacy * 1000:9.2f} ms, compiled {compiled * 1000:9.2f} ms, x{legacy / compiled:.1f}")
@@ -0,0 +1,56 @@
+"""
+Micro-benchmark: url extraction and note substitution on large pasted logs, single-pass spans vs. the old
+per-call regex compile and per-url `text.replace`.
+
+Usage: PYTHONPATH=. python benchmarks/bench_urls.py [lines_count]
+"""
+import re
+import sys
+import timeit
+from loguru import logger as log
+
+from ai_core.utils import find_urls, replace_spans
+
+
+def legacy_extract_urls(text):
+    regex = r"(?:|\()\/Content\/Attachments\/.*?(?: |\))"
+    urls = re.findall(regex, text)
+    for url in urls:
+        text = text.replace(url, "")
+    regex = r"(?:http[s]?:\/\/.)?(?:www\.)?[-a-zA-Z0-9@%._\+~#=]{2,256}\.[a-z]{2,6}\b(?:[-a-zA-Z0-9@:%_\+.~#?&\/\/=]*)"
+    urls.extend(re.findall(regex, text))
+    return [url.replace("(", "").replace(")", "").replace("\n", "") for url in urls]
+
+def legacy_substitute(text):
+    for url in legacy_extract_urls(text):
+        text = text.replace(url, f"<vision_system_note>url: {url}</vision_system_note>")
+    return text
+
+def substitute(text):
+    return replace_spans(text, [
+        (match.start, match.end, f"<vision_system_note>url: {match.raw}</vision_system_note>")
+        for match in find_urls(text)
+    ])
+
+def make_log(count):
+    lines = []
+    for i in range(count):
+        if i % 3 == 0:
+            lines.append(f"[12:{i % 60:02d}] GET https://service{i}.example.com/api/v1/items?id={i} 200")
+        elif i % 3 == 1:
+            lines.append(f"[12:{i % 60:02d}] worker-{i} finished job {i} in {i % 17}ms")
+        else:
+            lines.append(f"[12:{i % 60:02d}] see /Content/Attachments/upload{i}.png for details")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    log.remove()
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    text = make_log(count)
+    # Legacy kept the trailing space of attachment urls
+    assert sorted(url.strip() for url in legacy_extract_urls(text)) == sorted(match.raw for match in find_urls(text))
+    number = 3
+    legacy = timeit.timeit(lambda: legacy_substitute(text), number=number) / number
+    spans = timeit.timeit(lambda: substitute(text), number=number) / number
+    print(f"{count} lines, {len(text)} chars: legacy {legacy * 1000:9.2f} ms, single pass {spans * 1000:9.2f} ms, x{legacy / spans:.1f}")
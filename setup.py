@@ -8,6 +8,7 @@ setup(
     author='Wrecksler',
     author_email='wrecksler@gmail.com',
     py_modules=['ai_core'],
+    python_requires='>=3.10',
     install_requires=[
             'loguru',
             'requests',
@@ -18,7 +19,11 @@ setup(
             'nltk',
             'pillow',
             'transformers',
+            'numpy',
     ],
+    extras_require={
+            'async': ['aiohttp'],
+    },
     packages=find_packages(exclude=['tests', 'tests.*']),
     package_data={
         '': ["*.yaml", "*.jinja2"],
@@ -0,0 +1,86 @@
+import asyncio
+
+from aiohttp import web
+
+from ai_core.integrations.openedai_async import AsyncOpenedAI
+
+OPENAPI = {"components": {"schemas": {
+    "CompletionRequest": {"properties": {"prompt": {}, "max_tokens": {}}},
+}}}
+
+
+class StubServer():
+    """Completion server which reverses prompts, later prompts answer sooner, so results come out of order."""
+
+    def __init__(self, count):
+        self.count = count
+        self.in_flight = 0
+        self.peak = 0
+
+    async def openapi(self, request):
+        return web.json_response(OPENAPI)
+
+    async def completions(self, request):
+        payload = await request.json()
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        try:
+            index = int(payload["prompt"].split()[-1])
+            await asyncio.sleep(0.01 * (self.count - index))
+        finally:
+            self.in_flight -= 1
+        return web.json_response({"choices": [{"text": payload["prompt"][::-1], "finish_reason": "stop"}]})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/openapi.json", self.openapi)
+        app.router.add_post("/v1/completions", self.completions)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = self.runner.addresses[0][:2]
+        return f"http://{host}:{port}"
+
+
+def run_with_server(count, test):
+    async def main():
+        server = StubServer(count)
+        host = await server.start()
+        try:
+            await test(server, host)
+        finally:
+            await server.runner.cleanup()
+    asyncio.run(main())
+
+
+def test_max_concurrency_caps_requests_in_flight():
+    count = 20
+    prompts = [f"prompt {i}" for i in range(count)]
+
+    async def test(server, host):
+        async with AsyncOpenedAI(host=host, max_concurrency=4) as completion:
+            results = await asyncio.gather(*[completion(prompt, {"max_tokens": 10}) for prompt in prompts])
+        assert results == [prompt[::-1] for prompt in prompts]
+        assert server.peak == 4
+
+    run_with_server(count, test)
+
+
+def test_batch_and_map_keep_input_order():
+    count = 12
+    prompts = [f"prompt {i}" for i in range(count)]
+
+    async def test(server, host):
+        async with AsyncOpenedAI(host=host, max_concurrency=16) as completion:
+            result = await completion.batch(prompts, {"max_tokens": 10}, max_workers=3)
+            assert server.peak == 3
+            assert result.results == [prompt[::-1] for prompt in prompts]
+            assert result.errors == {}
+
+            server.peak = 0
+            results = [text async for text in completion.map(prompts, {"max_tokens": 10}, max_workers=5)]
+            assert server.peak == 5
+            assert results == [prompt[::-1] for prompt in prompts]
+
+    run_with_server(count, test)
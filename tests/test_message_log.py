@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+from ai_core.memory import AIMessage, UserMessage
+from ai_core.memory import store
+from ai_core.memory.store import INDEX_ENTRY, MessageLog, Memory_Persistent
+from ai_core.utils.tokenizers import get_tokenizer, tokenizer_id
+
+
+def write_messages(path, count):
+    message_log = MessageLog(path)
+    message_log.extend([UserMessage(f"message {i}") for i in range(count)], list(range(count)))
+    message_log.close()
+
+
+def test_torn_index_is_truncated_before_append(tmp_path):
+    path = str(tmp_path / "log")
+    write_messages(path, 3)
+    with open(f"{path}.idx", "r+b") as f:
+        f.truncate(3 * INDEX_ENTRY.size - 5)
+
+    message_log = MessageLog(path)
+    assert [message.text for message in message_log] == ["message 0", "message 1", "message 2"]
+    message_log.append(AIMessage("reply"), 1)
+    message_log.close()
+
+    assert os.path.getsize(f"{path}.idx") == 4 * INDEX_ENTRY.size
+    message_log = MessageLog(path)
+    assert [message.text for message in message_log] == ["message 0", "message 1", "message 2", "reply"]
+    assert isinstance(message_log[-1], AIMessage)
+    assert list(message_log.token_counts) == [0, 1, 2, 1]
+    message_log.close()
+
+
+def test_lost_data_write_drops_index_entries(tmp_path):
+    path = str(tmp_path / "log")
+    write_messages(path, 3)
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 2)
+
+    message_log = MessageLog(path)
+    assert len(message_log) == 2
+    message_log.append(UserMessage("next"))
+    assert [message.text for message in message_log] == ["message 0", "message 1", "next"]
+    message_log.close()
+
+
+def test_open_files_are_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(store, "MAX_OPEN_LOGS", 4)
+    logs = [MessageLog(str(tmp_path / f"log{i}")) for i in range(20)]
+    for i, message_log in enumerate(logs):
+        message_log.append(UserMessage(f"message {i}"))
+    assert sum(message_log._data is not None for message_log in logs) <= 4
+    assert [message_log[0].text for message_log in logs] == [f"message {i}" for i in range(20)]
+    for message_log in logs:
+        message_log.close()
+
+
+def test_token_counts_of_other_tokenizer_are_recounted(tmp_path):
+    path = str(tmp_path / "log")
+    memory = Memory_Persistent(path=path, token_limit=100, tokenizer=lambda text: 1)
+    for i in range(5):
+        memory.add_message(UserMessage(f"message {i}"))
+    memory.close()
+
+    tokenizer = get_tokenizer("regex")
+    memory = Memory_Persistent(path=path, token_limit=100, tokenizer=tokenizer)
+    assert memory._store.record_tokenizer(0) != tokenizer_id(tokenizer)
+    assert memory.window_token_count == sum(tokenizer(str(message)) for message in memory.messages)
+    memory.add_message(UserMessage("next"))
+    assert memory._store.record_tokenizer(5) == tokenizer_id(tokenizer)
+    memory.close()
+
+
+def test_constructor_messages_are_written_to_log(tmp_path):
+    path = str(tmp_path / "log")
+    tokenizer = get_tokenizer("regex")
+    memory = Memory_Persistent(path=path, token_limit=100, tokenizer=tokenizer, messages_all=[UserMessage("hello")])
+    assert [message.text for message in memory.history] == ["hello"]
+    memory.close()
+
+    with pytest.raises(ValueError):
+        Memory_Persistent(path=path, token_limit=100, tokenizer=tokenizer, messages_all=[UserMessage("again")])